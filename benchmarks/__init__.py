@@ -0,0 +1,18 @@
+"""
+Benchmarks for django-photoprocessor.
+
+These are plain scripts rather than tests, run against the bundled
+``benchmarks`` app with SQLite and local file storage::
+
+    python -m benchmarks.import_time
+    python -m benchmarks.operations --rows 20 --latency 30
+
+"""
+import os
+
+
+def setup():
+    """ Points Django at the benchmark settings and creates the tables """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
@@ -0,0 +1,53 @@
+"""
+Measures how long a fresh interpreter takes to import the models of an app
+that uses ImageWithProcessorsField, with PIL left lazy (the default) and
+with PIL forced in up front as it used to be.
+
+    python -m benchmarks.import_time [runs]
+
+"""
+import os
+import subprocess
+import sys
+
+SCRIPT = """
+import time
+start = time.time()
+from django.conf import settings
+settings.INSTALLED_APPS
+if %(eager)r:
+    from photoprocessor import lib
+    lib.load()
+import benchmarks.models
+from photoprocessor import lib
+print time.time() - start, int(lib.is_loaded())
+"""
+
+
+def measure(eager, runs):
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    timings = list()
+    pil_loaded = False
+    for i in range(runs):
+        output = subprocess.Popen([sys.executable, '-c', SCRIPT % {'eager':eager}],
+                                  env=env, stdout=subprocess.PIPE).communicate()[0]
+        elapsed, loaded = output.split()
+        timings.append(float(elapsed))
+        pil_loaded = bool(int(loaded))
+    timings.sort()
+    return timings[len(timings) // 2], pil_loaded
+
+
+def main(argv):
+    runs = int(argv[1]) if len(argv) > 1 else 20
+    lazy, lazy_pil = measure(False, runs)
+    eager, eager_pil = measure(True, runs)
+    print "import benchmarks.models (median of %s runs)" % runs
+    print "  lazy:  %7.2f ms  PIL loaded: %s" % (lazy * 1000, lazy_pil)
+    print "  eager: %7.2f ms  PIL loaded: %s" % (eager * 1000, eager_pil)
+    print "  saved: %7.2f ms" % ((eager - lazy) * 1000)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
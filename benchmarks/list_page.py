@@ -0,0 +1,86 @@
+"""
+Simulates rendering a list page: every row touches the url, width and
+height of a few thumbnails. Reports how many field-file and ImageFile
+wrappers get constructed, with the per-instance cache and with the cache
+defeated to mimic the previous descriptor.
+
+    python -m benchmarks.list_page [rows]
+
+"""
+from __future__ import with_statement
+import sys
+import time
+
+import benchmarks
+benchmarks.setup()
+
+from photoprocessor.fields import ImageFile, ImageWithProcessorsFieldFile
+from benchmarks.models import Photo
+
+KEYS = ['thumbnail', 'medium']
+
+
+class ConstructionCounter(object):
+    def __init__(self, *classes):
+        self.classes = classes
+        self.counts = dict()
+
+    def __enter__(self):
+        self.originals = dict()
+        for cls in self.classes:
+            self.counts[cls.__name__] = 0
+            self.originals[cls] = cls.__init__
+            cls.__init__ = self.wrap(cls, cls.__init__)
+        return self
+
+    def __exit__(self, *exc_info):
+        for cls, init in self.originals.iteritems():
+            cls.__init__ = init
+
+    def wrap(self, cls, init):
+        counts = self.counts
+        def __init__(*args, **kwargs):
+            counts[cls.__name__] += 1
+            return init(*args, **kwargs)
+        return __init__
+
+
+def make_rows(count):
+    Photo.objects.all().delete()
+    for i in range(count):
+        data = {'original':{'path':'bench/%s.jpg' % i, 'info':{'size':{'width':2000, 'height':1500}}}}
+        for key in KEYS:
+            data[key] = {'path':'bench/%s-%s.jpg' % (i, key),
+                         'info':{'size':{'width':100, 'height':75}}}
+        Photo.objects.create(name=str(i), image=data)
+
+
+def render(objects, cached=True):
+    cache_name = Photo._meta.get_field('image').get_file_cache_name()
+    for obj in objects:
+        for key in KEYS:
+            for attr in ('url', 'width', 'height'):
+                if not cached:
+                    obj.__dict__.pop(cache_name, None)
+                thumb = obj.image[key]
+                value = getattr(thumb, attr)
+                if callable(value):
+                    value()
+
+
+def main(argv):
+    rows = int(argv[1]) if len(argv) > 1 else 100
+    make_rows(rows)
+    for cached in (False, True):
+        objects = list(Photo.objects.all())
+        with ConstructionCounter(ImageWithProcessorsFieldFile, ImageFile) as counter:
+            start = time.time()
+            render(objects, cached=cached)
+            elapsed = time.time() - start
+        print "%s: %s rows in %.2f ms, constructed %s" % (
+            cached and 'cached' or 'uncached', rows, elapsed * 1000,
+            ', '.join(['%s=%s' % item for item in sorted(counter.counts.items())]))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
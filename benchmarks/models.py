@@ -0,0 +1,13 @@
+from django.db import models
+
+from photoprocessor.fields import ImageWithProcessorsField
+
+from benchmarks.storage import bench_storage
+
+thumbnails = {'thumbnail':{'resize':{'width':100, 'height':100, 'crop':'center'}, 'quality':90},
+              'medium':{'resize':{'width':400, 'height':400, 'crop':'scale'}, 'quality':90},
+              'display':{'resize':{'width':1000, 'height':1000, 'crop':'scale'}, 'quality':90}}
+
+class Photo(models.Model):
+    name = models.CharField(max_length=100, blank=True)
+    image = ImageWithProcessorsField(upload_to='bench/%Y/%m', thumbnails=thumbnails, storage=bench_storage)
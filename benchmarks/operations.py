@@ -0,0 +1,145 @@
+"""
+Runs scripted scenarios against ImageWithProcessorsField and reports, per
+operation, the database queries, storage calls and wall time it cost:
+
+* upload: ``field_file.save()`` of a fresh JPEG
+* lazy miss: ``field_file[key]`` for a thumbnail that was never generated
+* list render: url, width and height of two thumbnails of a queried row
+* reprocess row: one row of ``reprocess_photos --force``
+
+    python -m benchmarks.operations [--rows N] [--latency MS] [--size WxH]
+
+``--latency`` adds a delay to every storage call to mimic a remote backend.
+"""
+from __future__ import with_statement
+from optparse import OptionParser
+from cStringIO import StringIO
+import os
+import time
+
+import benchmarks
+benchmarks.setup()
+
+from django.core.files.base import ContentFile
+from django.db import connection
+
+from photoprocessor.lib import Image
+from photoprocessor.management.commands.reprocess_photos import Command as ReprocessCommand
+from benchmarks.models import Photo
+from benchmarks.storage import bench_storage
+
+LIST_KEYS = ['thumbnail', 'medium']
+
+
+class Measurement(object):
+    """ Accumulates the queries, storage calls and time of repeated operations """
+    def __init__(self, name):
+        self.name = name
+        self.timings = list()
+        self.queries = 0
+        self.calls = dict()
+
+    def __enter__(self):
+        self.query_start = len(connection.queries)
+        self.call_start = len(bench_storage.calls)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.append(time.time() - self.start)
+        self.queries += len(connection.queries) - self.query_start
+        for method, name in bench_storage.calls[self.call_start:]:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def report(self):
+        runs = len(self.timings)
+        timings = sorted(self.timings)
+        calls = ', '.join(['%s=%.1f' % (method, float(count) / runs)
+                           for method, count in sorted(self.calls.items())]) or 'none'
+        print "%-14s %4s ops  %7.2f ms mean  %7.2f ms median  %5.1f queries  storage: %s" % (
+            self.name, runs, sum(timings) / runs * 1000, timings[runs // 2] * 1000,
+            float(self.queries) / runs, calls)
+
+
+def make_content(size, name='bench.jpg'):
+    """ A smooth, photo-like JPEG: random noise upscaled from a tiny image """
+    noise = os.urandom(32 * 24 * 3)
+    frombytes = getattr(Image, 'frombytes', None) or Image.fromstring
+    img = frombytes('RGB', (32, 24), noise).resize(size, Image.BICUBIC)
+    buf = StringIO()
+    img.save(buf, 'JPEG', quality=90)
+    content = ContentFile(buf.getvalue())
+    content.name = name
+    return content
+
+
+def upload(rows, size):
+    measurement = Measurement('upload')
+    photos = list()
+    for i in range(rows):
+        content = make_content(size)
+        photo = Photo(name=str(i))
+        with measurement:
+            photo.image.save('bench.jpg', content)
+        photos.append(photo)
+    return measurement, photos
+
+
+def lazy_miss(photos):
+    measurement = Measurement('lazy miss')
+    for photo in photos:
+        photo = Photo.objects.get(pk=photo.pk)
+        del photo.image.data['display']
+        with measurement:
+            photo.image['display'].url
+    return measurement
+
+
+def list_render():
+    measurement = Measurement('list render')
+    with measurement:
+        count = 0
+        for photo in Photo.objects.all():
+            count += 1
+            for key in LIST_KEYS:
+                thumb = photo.image[key]
+                thumb.url, thumb.width(), thumb.height()
+    #report per row rather than per page
+    measurement.timings = [measurement.timings[0] / count] * count
+    return measurement
+
+
+def reprocess(photos):
+    measurement = Measurement('reprocess row')
+    command = ReprocessCommand()
+    for photo in photos:
+        queryset = Photo.objects.filter(pk=photo.pk)
+        with measurement:
+            command.reprocess_model(Photo, ['image'], True, queryset)
+    return measurement
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--rows', type='int', default=20)
+    parser.add_option('--latency', type='float', default=0, help='milliseconds added to each storage call')
+    parser.add_option('--size', default='2000x1500')
+    options, args = parser.parse_args()
+    size = tuple([int(value) for value in options.size.split('x')])
+
+    connection.use_debug_cursor = True
+    bench_storage.latency = options.latency / 1000.0
+    Photo.objects.all().delete()
+
+    print "%s rows of %sx%s, %s ms storage latency" % (options.rows, size[0], size[1], options.latency)
+    measurement, photos = upload(options.rows, size)
+    measurement.report()
+    lazy_miss(photos).report()
+    list_render().report()
+    reprocess(photos).report()
+    for photo in photos:
+        photo.image.delete(save=False)
+
+
+if __name__ == '__main__':
+    main()
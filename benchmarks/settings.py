@@ -0,0 +1,23 @@
+# Django settings for the photoprocessor benchmarks.
+import os
+import tempfile
+
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+MEDIA_ROOT = tempfile.mkdtemp(prefix='photoprocessor-bench-')
+MEDIA_URL = '/media/'
+
+SECRET_KEY = 'photoprocessor-benchmarks'
+
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'photoprocessor',
+    'benchmarks',
+]
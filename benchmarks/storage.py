@@ -0,0 +1,7 @@
+"""
+The storage of the benchmark models, a RecordingStorage under the benchmark
+MEDIA_ROOT whose latency stands in for a remote backend such as S3.
+"""
+from photoprocessor.testing import RecordingStorage
+
+bench_storage = RecordingStorage()
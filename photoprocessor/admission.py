@@ -0,0 +1,162 @@
+"""
+Admission control for thumbnails generated inline by field_file[key].
+Configured with PHOTO_ADMISSION; a request over budget gets a stand-in
+instead of waiting on a decode, and the thumbnail_deferred signal is sent
+so the work can be queued elsewhere. Counters of admitted and deferred
+generations are kept per process and per host (in Django's cache).
+
+Every cache entry has an explicit timeout. The per-host counters cover a
+window of counter_window seconds: each window has its own keys, which
+expire one window after it ends, so the counts start again from zero with
+every window. The count of running decodes expires HOST_COUNTER_TIMEOUT
+seconds after the last decode started; if it expires while decodes are
+running their slots are freed early, and a crashed process holds its
+slots no longer than that. Backends with a native incr, such as memcached,
+keep these timeouts; the others write every increment back with their
+default timeout.
+"""
+from __future__ import with_statement
+import socket
+import threading
+import time
+
+#the count of running decodes expires so that a crashed process cannot hold a slot forever
+HOST_COUNTER_TIMEOUT = 300
+
+_budget = None
+_lock = threading.Lock()
+
+
+class Budget(object):
+    """
+    concurrent: decodes running at once in this process
+    host_concurrent: decodes running at once on this host
+    megapixels_per_second: source megapixels decoded per second in this process
+    max_pixels: the largest source generated inline at all
+    fallback: 'no_image' or 'placeholder', what is served when over budget
+    retry_after: seconds the thumbnail view asks clients to wait when over budget
+    counter_window: seconds covered by the per-host counters
+    """
+    def __init__(self, concurrent=None, host_concurrent=None, megapixels_per_second=None,
+                 max_pixels=None, fallback='no_image', retry_after=10, counter_window=3600,
+                 cache='default'):
+        self.slots = concurrent and threading.Semaphore(concurrent) or None
+        self.host_concurrent = host_concurrent
+        self.rate = megapixels_per_second and megapixels_per_second * 1000000.0 or None
+        self.max_pixels = max_pixels
+        self.fallback = fallback
+        self.retry_after = retry_after
+        self.counter_window = counter_window
+        self.cache_alias = cache
+        self.allowance = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.prefix = 'photoprocessor:admission:%s:' % socket.gethostname()
+
+    def get_cache(self):
+        from django.core.cache import get_cache
+        return get_cache(self.cache_alias)
+
+    def admit(self, pixels):
+        """
+        Takes a slot for decoding a source of pixels. Returns None when
+        admitted, and the caller must release() afterwards, or the reason
+        the generation has to be deferred.
+        """
+        if self.max_pixels and pixels > self.max_pixels:
+            return self.defer('too_large')
+        if self.slots is not None and not self.slots.acquire(False):
+            return self.defer('concurrency')
+        if self.host_concurrent and not self.acquire_host():
+            self.release_process()
+            return self.defer('host_concurrency')
+        if not self.take_pixels(pixels):
+            self.release()
+            return self.defer('rate')
+        self.count('admitted')
+        return None
+
+    def release(self):
+        if self.host_concurrent:
+            self.release_host()
+        self.release_process()
+
+    def release_process(self):
+        if self.slots is not None:
+            self.slots.release()
+
+    def take_pixels(self, pixels):
+        """ A token bucket holding one second's worth of megapixels """
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.updated) * self.rate)
+            self.updated = now
+            #a source larger than the whole bucket still gets in once it is full
+            if pixels > self.allowance and self.allowance < self.rate:
+                return False
+            self.allowance -= pixels
+            return True
+
+    def acquire_host(self):
+        cache = self.get_cache()
+        key = self.prefix + 'decodes'
+        cache.add(key, 0, HOST_COUNTER_TIMEOUT)
+        try:
+            if cache.incr(key) <= self.host_concurrent:
+                return True
+            cache.decr(key)
+        except ValueError:
+            #the counter was evicted, let the decode through
+            return True
+        return False
+
+    def release_host(self):
+        try:
+            self.get_cache().decr(self.prefix + 'decodes')
+        except ValueError:
+            pass
+
+    def defer(self, reason):
+        self.count('deferred')
+        self.count('deferred_%s' % reason)
+        return reason
+
+    def window_prefix(self):
+        """ The key prefix of the per-host counters of the current window """
+        window = int(time.time() // self.counter_window) * self.counter_window
+        return '%s%d:' % (self.prefix, window)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+        cache = self.get_cache()
+        key = self.window_prefix() + name
+        cache.add(key, 0, 2 * self.counter_window)
+        try:
+            cache.incr(key)
+        except ValueError:
+            pass
+
+    def host_counters(self):
+        """ The counters of every process on this host in the current window """
+        names = ['admitted', 'deferred', 'deferred_too_large', 'deferred_concurrency',
+                 'deferred_host_concurrency', 'deferred_rate']
+        prefix = self.window_prefix()
+        values = self.get_cache().get_many([prefix + name for name in names])
+        return dict([(name, values.get(prefix + name, 0)) for name in names])
+
+
+def get_budget():
+    """ The Budget configured by PHOTO_ADMISSION, None if there is none """
+    global _budget
+    from settings import ADMISSION
+    if not ADMISSION:
+        return None
+    if _budget is None:
+        with _lock:
+            if _budget is None:
+                _budget = Budget(**ADMISSION)
+    return _budget
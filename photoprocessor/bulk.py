@@ -0,0 +1,118 @@
+"""
+Bulk access to the thumbnails of many objects, e.g. for rendering a list
+page. Missing thumbnails are generated together and their metadata is
+written back in one UPDATE statement rather than one save() per object.
+"""
+from django.db import connections, router, transaction
+
+from utils import map_in_threads
+from urlcache import get_entries
+
+#keeps the number of query parameters below SQLite's limit of 999
+UPDATE_BATCH_SIZE = 300
+
+
+def resolve_thumbnails(objects, field_name, keys, generate=True, workers=None):
+    """
+    Returns a list of (object, {key: thumbnail}) pairs in the order of
+    `objects`, which may be a queryset or a list of model instances.
+    
+    With `generate`, missing thumbnails are produced first, each object's
+    original being decoded once, on up to `workers` threads, and the
+    changed field data is persisted in a single batched write.
+    """
+    objects = list(objects)
+    if not objects:
+        return []
+    
+    if generate:
+        jobs = list()
+        for obj in objects:
+            field_file = getattr(obj, field_name)
+            if field_file:
+                missing = field_file.missing_keys(keys)
+                if missing:
+                    jobs.append((obj, field_file, missing))
+        
+        def generate_job(job):
+            obj, field_file, missing = job
+            try:
+                field_file.generate_thumbnails(missing, save=False, force_reprocess=True)
+            except IOError:
+                #the original is unreadable, fall back to no_image below
+                return None
+            return obj
+        
+        changed = [obj for obj in map_in_threads(generate_job, jobs, workers) if obj is not None]
+        if changed:
+            save_field_data(changed, field_name)
+    
+    results = list()
+    for obj in objects:
+        field_file = getattr(obj, field_name)
+        thumbs = dict()
+        for key in keys:
+            if key in field_file.data or not field_file:
+                thumbs[key] = field_file[key]
+            else:
+                #generation was skipped or failed; do not retry inline
+                thumbs[key] = field_file.no_image()
+        results.append((obj, thumbs))
+    return results
+
+
+def prefetch_urls(objects, field_name, keys):
+    """
+    Resolves the urls of the given thumbnails (and 'original') of every
+    object with a single url cache lookup, so that rendering a page does
+    not call storage.url() or the cache once per thumbnail.
+    """
+    files = list()
+    for obj in objects:
+        field_file = getattr(obj, field_name)
+        if not field_file:
+            continue
+        for key in keys:
+            if key == 'original':
+                files.append(field_file)
+            elif key in field_file.data:
+                files.append(field_file[key])
+    if not files:
+        return
+    storage = files[0].storage
+    entries = get_entries(storage, set([image_file.name for image_file in files]))
+    for image_file in files:
+        image_file._url = entries[image_file.name]
+
+
+def save_field_data(objects, field_name):
+    """
+    Writes the current value of `field_name` for every object with one
+    UPDATE ... CASE statement per batch, bypassing Model.save().
+    """
+    model = type(objects[0])
+    field = model._meta.get_field(field_name)
+    pk_column = model._meta.pk.column
+    using = router.db_for_write(model, instance=objects[0])
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    
+    cursor = connection.cursor()
+    for start in range(0, len(objects), UPDATE_BATCH_SIZE):
+        batch = objects[start:start + UPDATE_BATCH_SIZE]
+        cases, params, pks = list(), list(), list()
+        for obj in batch:
+            cases.append('WHEN %s THEN %s')
+            params.append(obj.pk)
+            params.append(field.get_db_prep_save(getattr(obj, field.attname), connection=connection))
+            pks.append(obj.pk)
+        sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+            qn(model._meta.db_table), qn(field.column), qn(pk_column), ' '.join(cases),
+            qn(pk_column), ', '.join(['%s'] * len(pks)))
+        cursor.execute(sql, params + pks)
+    transaction.commit_unless_managed(using=using)
+    
+    if field.thumbnail_index:
+        #post_save is not sent for the raw update
+        for obj in objects:
+            field.update_thumbnail_index(obj)
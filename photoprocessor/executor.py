@@ -0,0 +1,40 @@
+"""
+A shared, bounded pool that runs field file operations off the calling
+thread. Anything with an ``apply_async(func, args)`` method returning an
+object with ``get(timeout=None)`` can be passed in its place, e.g. a
+``multiprocessing.pool.ThreadPool`` of your own.
+"""
+from __future__ import with_statement
+import threading
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                from settings import EXECUTOR_WORKERS
+                from utils import get_thread_pool
+                _executor = get_thread_pool(EXECUTOR_WORKERS)
+    return _executor
+
+
+def _run(func, args, kwargs):
+    from django.db import close_connection
+    try:
+        return func(*args, **kwargs)
+    finally:
+        #pool threads outlive the job, do not keep a connection open per thread
+        close_connection()
+
+
+def submit(func, *args, **kwargs):
+    """
+    Runs func(*args, **kwargs) on the executor and returns a result whose
+    get(timeout=None) waits for the return value or re-raises the error.
+    """
+    executor = kwargs.pop('executor', None) or get_executor()
+    return executor.apply_async(_run, (func, args, kwargs))
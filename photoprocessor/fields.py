@@ -5,15 +5,25 @@ from django.core.files.storage import default_storage
 from django.core.files import File
 from django.core.files.base import ContentFile
 from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django import forms
 
 from lib import Image
-from utils import img_to_fobj
-from processors import process_image, process_image_info
+from utils import img_to_fobj, sniff_image, map_in_threads, file_digest, open_upload, read_upload, \
+    BackgroundCall, StorageWriter, thumbnail_signature
+from processors import Pipeline
+from executor import submit
+from isolation import get_pool as get_isolated_pool
+from urlcache import get_entry as get_url_entry, is_current, invalidate as invalidate_urls
+from admission import get_budget
+from large import reduced_size
+from signals import thumbnail_deferred
 
 import logging
 import os
 import datetime
+import hashlib
+import sys
 
 class JSONFieldDescriptor(object):
     def __init__(self, field):
@@ -122,6 +132,15 @@ class ImageFile(FieldFile):
         self.key = key
         name = self.image_data['path']
         FieldFile.__init__(self, instance, field, name)
+        self._url = None
+    
+    def _get_url(self):
+        self._require_file()
+        #remembered only as long as the url cache keeps it, signed urls expire
+        if not is_current(self._url):
+            self._url = get_url_entry(self.storage, self.name)
+        return self._url[0]
+    url = property(_get_url)
     
     @property
     def info(self):
@@ -139,6 +158,20 @@ class ImageFile(FieldFile):
     def delete(self, *args, **kwargs):
         raise NotImplementedError
 
+class DeferredImage(object):
+    """ Stands in for a thumbnail whose generation was deferred """
+    def __init__(self, url, size=None):
+        self.url = url
+        self.info = dict()
+        if size:
+            self.info['size'] = {'width':size[0], 'height':size[1]}
+    
+    def width(self):
+        return self.info.get('size', {}).get('width')
+    
+    def height(self):
+        return self.info.get('size', {}).get('height')
+
 class ImageWithProcessorsFieldFile(FieldFile):
     def __init__(self, instance, field, data):
         if isinstance(data, basestring):
@@ -150,6 +183,27 @@ class ImageWithProcessorsFieldFile(FieldFile):
             self.data['original'] = self.image_data
         name = self.image_data.get('path', None)
         FieldFile.__init__(self, instance, field, name)
+        self._thumbnails = dict()
+        self._source_image = None
+        self._source_data = None
+        self._proxy_image = None
+        self._proxy_data = None
+        self._url = None
+    
+    def _clear_caches(self):
+        self._thumbnails.clear()
+        self._source_image = None
+        self._source_data = None
+        self._proxy_image = None
+        self._proxy_data = None
+        self._url = None
+    
+    def _get_thumbnail(self, key):
+        #ImageFile wrappers are reused for as long as their data is unchanged
+        thumb = self._thumbnails.get(key)
+        if thumb is None or thumb.image_data is not self.data.get(key):
+            thumb = self._thumbnails[key] = ImageFile(self.instance, self.field, self.data, key)
+        return thumb
     
     def image(self):
         self.file.open()
@@ -161,6 +215,94 @@ class ImageWithProcessorsFieldFile(FieldFile):
             cf = ContentFile(self.file.read())
             return Image.open(cf)
     
+    def source_image(self):
+        """
+        The original for processing. With generate_siblings the decoded
+        image is kept for the lifetime of this field file.
+        """
+        if not self.field.generate_siblings:
+            return self.image()
+        if self._source_image is None:
+            self._source_image = self.image()
+        return self._source_image
+    
+    def source_data(self):
+        """ The encoded bytes of the original, read from storage once """
+        if self._source_data is None:
+            self.file.open()
+            self.file.seek(0)
+            self._source_data = self.file.read()
+        return self._source_data
+    
+    def proxy_image(self):
+        """ The downscaled proxy of the original, opened once """
+        if self._proxy_image is None:
+            self._proxy_image = Image.open(ContentFile(self.proxy_data()))
+        return self._proxy_image
+    
+    def proxy_data(self):
+        if self._proxy_data is None:
+            fobj = self.storage.open(self.data['proxy']['path'])
+            try:
+                self._proxy_data = fobj.read()
+            finally:
+                fobj.close()
+        return self._proxy_data
+    
+    def proxy_is_current(self):
+        proxy = self.data.get('proxy')
+        return bool(proxy) and proxy.get('fingerprint') == self.field.get_proxy_pipeline().fingerprint
+    
+    def proxy_satisfies(self, pipeline):
+        """
+        True if rendering pipeline from the proxy gives what the original
+        would: the spec only downscales, no further than the proxy already is.
+        """
+        if not self.field.proxy or not self.proxy_is_current() or not self.needs_proxy():
+            return False
+        size = self.image_data.get('info', {}).get('size')
+        proxy_size = self.data['proxy'].get('info', {}).get('size')
+        if not size or not proxy_size:
+            return False
+        scale = pipeline.required_scale((size['width'], size['height']))
+        if scale is None:
+            return False
+        width, height = reduced_size((size['width'], size['height']), scale)
+        return proxy_size['width'] >= width and proxy_size['height'] >= height
+    
+    def needs_proxy(self):
+        """
+        Whether the original is larger than the proxy, a smaller one would
+        only be re-encoded at full size.
+        """
+        size = self.image_data.get('info', {}).get('size')
+        return bool(size) and max(size['width'], size['height']) > self.field.get_proxy_options()['size']
+    
+    def discard_proxy(self):
+        proxy = self.data.pop('proxy', None)
+        if proxy and not proxy.get('shared'):
+            self.storage.delete(proxy['path'])
+        self._proxy_image = self._proxy_data = None
+    discard_proxy.alters_data = True
+    
+    def generate_proxy(self, source_image=None, name=None):
+        """
+        Stores the downscaled proxy of the original that later processing
+        reuses, or drops the proxy when the original is no larger than it.
+        """
+        if not self.needs_proxy():
+            self.discard_proxy()
+            return
+        base_name, base_ext = os.path.splitext(os.path.basename(name or self.name))
+        proxy_name = self.field.generate_filename(self.instance, '%s-proxy%s' % (base_name, base_ext))
+        if source_image is None and not self.field.is_isolated():
+            source_image = self.source_image()
+        proxy = self._process_thumbnail(source_image, proxy_name, self.field.get_proxy_pipeline())
+        proxy.pop('shared', None)
+        self.data['proxy'] = proxy
+        self._proxy_image = self._proxy_data = None
+    generate_proxy.alters_data = True
+    
     @property
     def info(self):
         return self.image_data['info']
@@ -183,68 +325,309 @@ class ImageWithProcessorsFieldFile(FieldFile):
         if key in self.field.thumbnails:
             if key not in self.data and 'original' in self.data:
                 #generate image
-                name = self.name
-                base_name, base_ext = os.path.splitext(os.path.basename(name))
+                keys = [key]
+                if self.field.generate_siblings:
+                    #one decode and one save for every missing or stale spec
+                    keys = None
                 try:
-                    source_image = self.image()
+                    reason = self.generate_admitted(keys, force_reprocess=keys is not None)
                 except IOError:
-                    if self.field.no_image is not None:
-                        return self.field.no_image
-                    return FieldFile(self.instance, self.field, None)
-                config = self.field.thumbnails[key]
-                
-                thumb_name = '%s-%s%s' % (base_name, key, base_ext)
-                self.data[key] = self._process_thumbnail(source_image, thumb_name, config)
-                self.instance.save()
+                    return self.no_image()
+                if reason is not None:
+                    return self.deferred_image(key, get_budget().fallback)
             
             if key in self.data:
-                return ImageFile(self.instance, self.field, self.data, key)
-            if self.field.no_image is not None:
-                return self.field.no_image
-            return FieldFile(self.instance, self.field, None)
+                return self._get_thumbnail(key)
+            return self.no_image()
         raise KeyError
     
-    def _process_thumbnail(self, source_image, thumb_name, config):
-        img, info = process_image(source_image, config)
-        
-        thumb_name = self.field.generate_filename(self.instance, thumb_name)
-        #not efficient, requires image to be loaded into memory
-        thumb_fobj = ContentFile(img_to_fobj(img, info).read())
-        thumb_name = self.storage.save(thumb_name, thumb_fobj)
+    def no_image(self):
+        """ The stand-in returned for thumbnails that cannot be produced """
+        if self.field.no_image is not None:
+            return self.field.no_image
+        return FieldFile(self.instance, self.field, None)
+    
+    def run_admitted(self, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs), which decodes the original, within the
+        PHOTO_ADMISSION budget. Returns the reason it was not called when
+        over budget, otherwise None.
+        """
+        budget = get_budget()
+        if budget is None:
+            func(*args, **kwargs)
+            return None
+        reason = budget.admit(self._source_pixels())
+        if reason is not None:
+            return reason
+        try:
+            func(*args, **kwargs)
+        finally:
+            budget.release()
+        return None
+    
+    def generate_admitted(self, keys=None, force_reprocess=False):
+        """
+        generate_thumbnails within the PHOTO_ADMISSION budget. Over budget
+        nothing is generated, thumbnail_deferred is sent and the reason is
+        returned; otherwise returns None.
+        """
+        reason = self.run_admitted(self.generate_thumbnails, keys, force_reprocess=force_reprocess)
+        if reason is not None:
+            thumbnail_deferred.send(sender=type(self.instance), field_file=self,
+                                    keys=keys is None and self.missing_keys() or keys, reason=reason)
+        return reason
+    generate_admitted.alters_data = True
+    
+    def deferred_image(self, key, fallback='no_image'):
+        """
+        The stand-in for a thumbnail that was not generated inline: no_image,
+        or with the 'placeholder' fallback the url of the view that generates
+        it along with its predicted dimensions.
+        """
+        if fallback != 'placeholder':
+            return self.no_image()
+        from django.core.urlresolvers import NoReverseMatch
+        try:
+            url = self.lazy_url(key)
+        except (NoReverseMatch, ImproperlyConfigured):
+            return self.no_image()
+        size = self.image_data.get('info', {}).get('size')
+        if size:
+            size = self.field.get_pipeline(key).predict_size((size['width'], size['height']))
+        return DeferredImage(url, size)
+    
+    def _source_pixels(self):
+        size = self.image_data.get('info', {}).get('size')
+        if not size:
+            return 0
+        return size['width'] * size['height']
+    
+    def lazy_url(self, key):
+        """
+        The url of thumbnail key without generating it: the stored file if
+        it is current, otherwise the view that generates it on request.
+        """
+        if key not in self.field.thumbnails:
+            raise KeyError
+        if not self:
+            return self.no_image().url
+        if self.is_current(key):
+            return self[key].url
+        if not self.field.serve:
+            raise ImproperlyConfigured("%s.%s is not served by the thumbnail view, set serve=True" % (
+                self.instance._meta.object_name, self.field.name))
+        from django.core.urlresolvers import reverse
+        opts = self.instance._meta
+        kwargs = {'app_label':opts.app_label,
+                  'model_name':opts.object_name.lower(),
+                  'pk':self.instance.pk,
+                  'field_name':self.field.name,
+                  'key':key,}
+        return '%s?sig=%s' % (reverse('photoprocessor-thumbnail', kwargs=kwargs), thumbnail_signature(**kwargs))
+    
+    def is_current(self, key):
+        """
+        Returns True if the stored thumbnail for key was produced by the
+        current spec.
+        """
+        return self.field.is_current(self.data, key)
+    
+    def missing_keys(self, keys=None):
+        if keys is None:
+            keys = self.field.thumbnails.keys()
+        return [key for key in keys if key not in self.data]
+    
+    def generate_thumbnails(self, keys=None, save=True, force_reprocess=False):
+        """
+        Processes the given thumbnails (all by default) that are missing or
+        stale from a single decode of the original. Returns the keys that
+        were generated.
+        """
+        if keys is None:
+            keys = self.field.thumbnails.keys()
+        if not force_reprocess:
+            keys = [key for key in keys if not self.is_current(key)]
+        if not keys:
+            return keys
+        self._process_thumbnails(keys)
+        if save:
+            self.instance.save()
+        return keys
+    generate_thumbnails.alters_data = True
+    
+    def _process_thumbnails(self, keys, source_image=None, name=None, use_proxy=True):
+        """
+        Produces the thumbnails for keys. The original is only decoded if
+        at least one of them actually has to be rendered, and the data is
+        only updated once every thumbnail has been stored. use_proxy=False
+        renders from the original even where the proxy would do.
+        """
+        base_name, base_ext = os.path.splitext(os.path.basename(name or self.name))
+        writer = self.field.get_storage_writer()
+        processed = dict()
+        try:
+            for key in keys: #TODO rename to specs
+                pipeline = self.field.get_pipeline(key)
+                if self.field.content_addressed:
+                    thumb_name = self.field.content_addressed_name(self.source_digest(), pipeline, base_ext)
+                    if self.storage.exists(thumb_name):
+                        processed[key] = self._existing_thumbnail(thumb_name, pipeline)
+                        continue
+                else:
+                    thumb_name = self.field.generate_filename(self.instance, '%s-%s%s' % (base_name, key, base_ext))
+                if use_proxy and source_image is None and self.proxy_satisfies(pipeline):
+                    #a fraction of the bytes to read and pixels to decode
+                    image = not self.field.is_isolated() and self.proxy_image() or None
+                    processed[key] = self._process_thumbnail(image, thumb_name, pipeline, writer, proxy=True)
+                    continue
+                if source_image is None and not self.field.is_isolated():
+                    source_image = self.source_image()
+                processed[key] = self._process_thumbnail(source_image, thumb_name, pipeline, writer)
+            if writer is not None:
+                writer.join()
+        except:
+            #uploads already queued must not be left behind
+            exc_info = sys.exc_info()
+            if writer is not None:
+                try:
+                    for stored in writer.join():
+                        self.storage.delete(stored)
+                except Exception:
+                    pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.data.update(processed)
+        #a storage may hand out the name of a deleted file again
+        invalidate_urls(self.storage, [thumb['path'] for thumb in processed.values()])
+    
+    def _process_thumbnail(self, source_image, thumb_name, pipeline, writer=None, proxy=False):
+        if self.field.is_isolated():
+            source_data = proxy and self.proxy_data() or self.source_data()
+            data, info = get_isolated_pool().render(source_data, pipeline.config, self._seed())
+            thumb_fobj = ContentFile(data)
+        else:
+            img, info = pipeline.process(source_image, self._seed())
+            #not efficient, requires image to be loaded into memory
+            thumb_fobj = ContentFile(img_to_fobj(img, info).read())
+        info['filesize'] = thumb_fobj.size
         
-        return {'path':thumb_name, 'config':config, 'info':info}
+        thumb = {'path':thumb_name, 'config':pipeline.config,
+                 'fingerprint':pipeline.fingerprint, 'info':info}
+        if self.field.content_addressed:
+            thumb['shared'] = True
+        if writer is None:
+            thumb['path'] = self.storage.save(thumb_name, thumb_fobj)
+        else:
+            writer.save(thumb_name, thumb_fobj, lambda name: thumb.__setitem__('path', name))
+        return thumb
+    
+    def _seed(self):
+        """ What processing a thumbnail may reuse from the original's info """
+        info = self.image_data.get('info') or {}
+        if 'focal_point' in info:
+            return {'focal_point':info['focal_point']}
+        return None
+    
+    def _existing_thumbnail(self, thumb_name, pipeline):
+        """ Describes a content addressed thumbnail that is already stored """
+        fobj = self.storage.open(thumb_name)
+        try:
+            format, size = sniff_image(fobj)
+        finally:
+            fobj.close()
+        info = {'format':format,
+                'size':{'width':size[0], 'height':size[1]},
+                'filesize':self.storage.size(thumb_name),}
+        return {'path':thumb_name, 'config':pipeline.config,
+                'fingerprint':pipeline.fingerprint, 'info':info, 'shared':True}
+    
+    def source_digest(self):
+        """
+        The sha1 of the original's content, recorded when it was saved or
+        computed from storage (and kept in the data) for older rows.
+        """
+        if 'digest' not in self.image_data:
+            self.file.open()
+            self.image_data['digest'] = file_digest(self.file)
+        return self.image_data['digest']
     
     def _get_url(self):
         if not self and self.field.no_image is not None:
             return self.field.no_image.url
-        return FieldFile._get_url(self)
+        self._require_file()
+        #remembered only as long as the url cache keeps it, signed urls expire
+        if not is_current(self._url):
+            self._url = get_url_entry(self.storage, self.name)
+        return self._url[0]
     url = property(_get_url)
     
+    def _process_info(self, pipeline, source_image=None, threshold=None):
+        """ The info pipeline gives for the original, in a child process when isolated """
+        if self.field.is_isolated():
+            return get_isolated_pool().info(self.source_data(), pipeline.config, threshold)
+        if source_image is None:
+            source_image = self.source_image()
+        return pipeline.process_info(source_image, threshold)
+    
+    def _update_info(self, source_image=None):
+        """ Builds the info of the original and records the spec it came from """
+        pipeline = self.field.get_info_pipeline()
+        self.image_data['info'] = self._process_info(pipeline, source_image)
+        self.image_data['fingerprint'] = pipeline.fingerprint
+    
+    def info_is_current(self):
+        """ True if the stored info of the original was built by the current info spec """
+        return 'info' in self.image_data and \
+            self.image_data.get('fingerprint') == self.field.get_info_pipeline().fingerprint
+    
     def reprocess_info(self, save=True):
-        source_image = self.image()
-        self.data['original']['info'] = process_image_info(source_image)
+        self._update_info()
         if save:
             self.instance.save()
     reprocess_info.alters_data = True
     
+    def reprocess_placeholder(self, save=True):
+        """
+        Backfills the placeholder and dominant color of the original from a
+        reduced decode, isolated and within the admission budget like any
+        other decode. Returns the reason when over budget, otherwise None.
+        """
+        spec = self.field.get_info_spec()
+        if 'placeholder' not in spec:
+            return None
+        pipeline = Pipeline({'placeholder':spec['placeholder']})
+        found = dict()
+        #reduce whatever the source size, nothing else needs its pixels
+        reason = self.run_admitted(lambda: found.update(self._process_info(pipeline, threshold=1)))
+        if reason is not None:
+            return reason
+        info = self.image_data.setdefault('info', {})
+        for name in ('placeholder', 'color'):
+            if name in found:
+                info[name] = found[name]
+        if save:
+            self.instance.save()
+        return None
+    reprocess_placeholder.alters_data = True
+    
     def reprocess_thumbnail_info(self, save=True):
-        source_image = self.image()
-        for key, config in self.field.thumbnails.iteritems():
+        source_image = None
+        for key in self.field.thumbnails:
             if key in self.data:
-                info = process_image_info(source_image, config)
+                pipeline = self.field.get_pipeline(key)
+                if self.field.is_isolated():
+                    info = get_isolated_pool().info(self.source_data(), pipeline.config)
+                else:
+                    if source_image is None:
+                        source_image = self.source_image()
+                    info = pipeline.process_info(source_image)
                 self.data[key]['info'] = info
         if save:
             self.instance.save()
     reprocess_thumbnail_info.alters_data = True
     
     def reprocess_thumbnails(self, save=True, force_reprocess=False):
-        base_name, base_ext = os.path.splitext(os.path.basename(self.name))
-        source_image = self.image()
-        for key, config in self.field.thumbnails.iteritems(): #TODO rename to specs
-            if not force_reprocess and key in self.data and self.data[key].get('config') == config:
-                continue
-            thumb_name = '%s-%s%s' % (base_name, key, base_ext)
-            self.data[key] = self._process_thumbnail(source_image, thumb_name, config)
+        self.generate_thumbnails(save=False, force_reprocess=force_reprocess)
 
         # Save the object because it has changed, unless save is False
         if save:
@@ -252,37 +635,156 @@ class ImageWithProcessorsFieldFile(FieldFile):
     reprocess_thumbnails.alters_data = True
     
     def reprocess(self, save=True, force_reprocess=False):
-        self.reprocess_info(save=False)
+        #the original is only read when its info is out of date or a spec needs it
+        if force_reprocess or not self.info_is_current():
+            self.reprocess_info(save=False)
+        if self.field.proxy and (force_reprocess or not self.proxy_is_current() or not self.needs_proxy()):
+            self.generate_proxy()
         self.reprocess_thumbnails(save=False, force_reprocess=force_reprocess)
         if save:
             self.instance.save()
     reprocess.alters_data = True
     
     def save(self, name, content, save=True, force_reprocess=True):
+        #reject oversized uploads before anything is stored or decoded
+        self.field.validate_image(content)
         name = self.field.generate_filename(self.instance, name)
-        self.name = self.storage.save(name, content)
-        self.data['original'] = {'path':self.name}
+        
+        #read the upload once, hashing it on the way when the digest is needed
+        sha1 = digest = None
+        if self.field.content_addressed or self.field.deduplicate:
+            sha1 = hashlib.sha1()
+        source_image = source_data = None
+        if self.field.is_isolated():
+            source_data = read_upload(content, sha1)
+        else:
+            #only the header is parsed until the pixels are needed
+            source_image = open_upload(content, sha1)
+        if sha1 is not None:
+            digest = sha1.hexdigest()
+        previous = self.image_data.get('shared') and self.image_data.get('digest')
+        if self.field.deduplicate:
+            from photoprocessor.models import SharedImage
+            shared = SharedImage.objects.acquire(self.field, digest)
+            if shared is not None:
+                self._save_shared(shared, digest, content.size)
+                self._release_previous(previous)
+                if save:
+                    self.instance.save()
+                return
+        
+        #decode from the content in hand while the original is stored in the background
+        upload = BackgroundCall(self.storage.save, name, content)
+        old_data = dict(self.data)
+        self.data['original'] = {}
+        self.image_data = self.data['original']
+        if digest:
+            self.image_data['digest'] = digest
+        self._clear_caches()
+        self._source_data = source_data
+        
+        #now update the children
+        try:
+            #the info first, thumbnails reuse what it found (e.g. the focal point)
+            self._update_info(source_image)
+            if self.field.proxy:
+                self.data.pop('proxy', None)
+                self.generate_proxy(source_image, name)
+            keys = self.field.thumbnails.keys()
+            if not force_reprocess:
+                keys = [key for key in keys if not self.is_current(key)]
+            #the upload is in hand, the proxy is only for later reprocessing
+            self._process_thumbnails(keys, source_image, name, use_proxy=False)
+            self.name = upload.get()
+        except:
+            #do not leave the original, the proxy or the thumbnails behind
+            exc_info = sys.exc_info()
+            self._discard_upload(upload, old_data)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        
+        self.image_data['path'] = self.name
+        invalidate_urls(self.storage, [self.name])
+        if self.field.deduplicate:
+            self._share(digest)
+        self._release_previous(previous)
 
         # Update the filesize cache
         self._size = content.size
         self._committed = True
-        
-        #now update the children
-        base_name, base_ext = os.path.splitext(os.path.basename(name))
-        source_image = self.image()
-        for key, config in self.field.thumbnails.iteritems(): #TODO rename to specs
-            if not force_reprocess and key in self.data and self.data[key].get('config') == config:
-                continue
-            thumb_name = '%s-%s%s' % (base_name, key, base_ext)
-            self.data[key] = self._process_thumbnail(source_image, thumb_name, config)
-        
-        self.data['original']['info'] = process_image_info(source_image)
-        self.image_data = self.data['original']
 
         # Save the object because it has changed, unless save is False
         if save:
             self.instance.save()
     save.alters_data = True
+    
+    def _discard_upload(self, upload, old_data):
+        """
+        Deletes what a failed save() stored and puts back the data it
+        started from.
+        """
+        paths = [image['path'] for key, image in self.data.items()
+                 if key != 'original' and image is not old_data.get(key)
+                 and image.get('path') and not image.get('shared')]
+        try:
+            paths.append(upload.get())
+        except Exception:
+            pass
+        for path in paths:
+            try:
+                self.storage.delete(path)
+            except Exception:
+                pass
+        self.data.clear()
+        self.data.update(old_data)
+        self.image_data = self.data.get('original', dict())
+        self._clear_caches()
+    
+    def _save_shared(self, data, digest, size):
+        """
+        Points this file at the stored copy of identical content, reusing
+        every thumbnail whose spec is unchanged and rendering the rest.
+        """
+        from photoprocessor.models import SharedImage
+        if hasattr(self, '_file'):
+            self.close()
+            del self.file
+        self.data['original'] = dict(data['original'], shared=True)
+        self.image_data = self.data['original']
+        self._clear_caches()
+        for key in self.field.thumbnails:
+            thumb = data.get(key)
+            if thumb and thumb.get('fingerprint') == self.field.get_pipeline(key).fingerprint:
+                self.data[key] = dict(thumb, shared=True)
+            else:
+                self.data.pop(key, None)
+        self.data.pop('proxy', None)
+        if self.field.proxy and 'proxy' in data:
+            self.data['proxy'] = dict(data['proxy'], shared=True)
+        self.name = self.image_data['path']
+        try:
+            self._process_thumbnails(self.missing_keys())
+        except:
+            exc_info = sys.exc_info()
+            SharedImage.objects.release(self.field, digest)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._size = size
+        self._committed = True
+    
+    def _share(self, digest):
+        """ Offers the freshly stored original and thumbnails for reuse """
+        from photoprocessor.models import SharedImage
+        keys = self.field.thumbnails.keys() + ['proxy']
+        images = dict([(key, self.data[key]) for key in keys if key in self.data])
+        images['original'] = self.image_data
+        if SharedImage.objects.register(self.field, digest, images):
+            for image in images.values():
+                image['shared'] = True
+    
+    def _release_previous(self, digest):
+        #the replaced image's files are left for cleanup_photos
+        if digest:
+            from photoprocessor.models import SharedImage
+            SharedImage.objects.release(self.field, digest)
 
     def delete(self, save=True):
         # Only close the file if it's already open, which we know by the
@@ -291,15 +793,29 @@ class ImageWithProcessorsFieldFile(FieldFile):
             self.close()
             del self.file
 
-        self.storage.delete(self.name)
-        
-        for key, image in self.data.iteritems():
+        paths = [self.name]
+        if self.image_data.get('shared'):
+            from photoprocessor.models import SharedImage
+            paths = list()
+            images = SharedImage.objects.release(self.field, self.image_data['digest'])
+            if images is not None:
+                #the last reference is gone, so are the shared files
+                paths = [image['path'] for image in images.values() if not image.get('shared')]
+        for key, image in self.data.items():
             if key != 'original':
-                self.storage.delete(image['path'])
+                #shared thumbnails are left for cleanup_photos
+                if not image.get('shared'):
+                    paths.append(image['path'])
+                del self.data[key]
+        from settings import DELETE_WORKERS
+        paths = [path for path in paths if path]
+        map_in_threads(self.storage.delete, paths, DELETE_WORKERS)
+        invalidate_urls(self.storage, paths)
 
         self.name = None
         self.data['original'] = {}
         self.image_data = self.data['original']
+        self._clear_caches()
 
         # Delete the filesize cache
         if hasattr(self, '_size'):
@@ -310,6 +826,27 @@ class ImageWithProcessorsFieldFile(FieldFile):
             self.instance.save()
     delete.alters_data = True
     
+    # Non-blocking variants. Each runs the operation on the shared executor
+    # (or the one given) and returns a result whose get(timeout=None) waits
+    # for it; the field file must not be used until then.
+    
+    def asave(self, name, content, save=True, force_reprocess=True, executor=None):
+        return submit(self.save, name, content, save=save, force_reprocess=force_reprocess, executor=executor)
+    asave.alters_data = True
+    
+    def areprocess(self, save=True, force_reprocess=False, executor=None):
+        return submit(self.reprocess, save=save, force_reprocess=force_reprocess, executor=executor)
+    areprocess.alters_data = True
+    
+    def aget(self, key, executor=None):
+        if key not in self.field.thumbnails:
+            raise KeyError
+        return submit(self.__getitem__, key, executor=executor)
+    
+    def adelete(self, save=True, executor=None):
+        return submit(self.delete, save=save, executor=executor)
+    adelete.alters_data = True
+    
     def _require_file(self):
         if self.field.no_image is not None:
             return
@@ -324,9 +861,16 @@ class ImageWithProcessorsDesciptor(JSONFieldDescriptor):
         
         data = JSONFieldDescriptor.__get__(self, instance, owner)
         
-        return self.field.attr_class(instance, self.field, data)
+        #reuse the field file for as long as the underlying data is unchanged
+        cache_name = self.field.get_file_cache_name()
+        field_file = instance.__dict__.get(cache_name)
+        if getattr(field_file, 'data', None) is not data:
+            field_file = self.field.attr_class(instance, self.field, data)
+            instance.__dict__[cache_name] = field_file
+        return field_file
 
     def __set__(self, instance, value):
+        instance.__dict__.pop(self.field.get_file_cache_name(), None)
         if isinstance(value, basestring):
             try:
                 self.field.loads(value)
@@ -356,6 +900,27 @@ class ImageWithProcessorsField(JSONField):
         self.upload_to = kwargs.pop('upload_to')
         self.no_image = kwargs.pop('no_image', None)
         self.storage = kwargs.pop('storage', default_storage)
+        self.max_pixels = kwargs.pop('max_pixels', None)
+        self.max_dimensions = kwargs.pop('max_dimensions', None) #(width, height)
+        self.allowed_formats = kwargs.pop('allowed_formats', None)
+        self.thumbnail_index = kwargs.pop('thumbnail_index', False)
+        self.content_addressed = kwargs.pop('content_addressed', False)
+        self.write_behind = kwargs.pop('write_behind', None)
+        self.generate_siblings = kwargs.pop('generate_siblings', False)
+        #e.g. {'exif':['DateTimeOriginal', 'Make', 'Model'], 'profile':'convert'}
+        self.metadata = kwargs.pop('metadata', None)
+        self.isolated = kwargs.pop('isolated', None)
+        self.deduplicate = kwargs.pop('deduplicate', False)
+        #True or e.g. {'size':16, 'quality':40}
+        self.placeholder = kwargs.pop('placeholder', None)
+        #the longest edge of a downscaled copy kept for reprocessing, or
+        #{'size':2048, 'quality':95}
+        self.proxy = kwargs.pop('proxy', None)
+        #answer requests for missing thumbnails through the thumbnail view
+        self.serve = kwargs.pop('serve', False)
+        self._proxy_pipeline = None
+        self._info_pipeline = None
+        self.pipelines = dict()
         JSONField.__init__(self, **kwargs)
     
     def value_to_string(self, obj):
@@ -370,6 +935,173 @@ class ImageWithProcessorsField(JSONField):
         self = copy(self) #allow inherited models to have their own thumbnails defined
         super(ImageWithProcessorsField, self).contribute_to_class(cls, name)
         setattr(cls, self.name, self.descriptor_class(self))
+        self.pipelines = self.compile_pipelines()
+        if self.thumbnail_index and not cls._meta.abstract:
+            #the primary key is only known once every field was added
+            models.signals.class_prepared.connect(self.check_thumbnail_index, sender=cls)
+            models.signals.post_save.connect(self.update_thumbnail_index, sender=cls)
+            models.signals.post_delete.connect(self.clear_thumbnail_index, sender=cls)
+    
+    def check_thumbnail_index(self, sender, **kwargs):
+        """ ThumbnailIndex.object_id holds integers only """
+        pk = sender._meta.pk
+        while pk.rel is not None: #inherited or one-to-one primary keys
+            pk = pk.rel.get_related_field()
+        if not isinstance(pk, (models.AutoField, models.IntegerField)):
+            raise ImproperlyConfigured("%s.%s: thumbnail_index=True needs an integer primary key, not %s"
+                                       % (sender.__name__, self.name, type(pk).__name__))
+    
+    def update_thumbnail_index(self, instance, **kwargs):
+        from photoprocessor.models import ThumbnailIndex
+        ThumbnailIndex.objects.sync(instance, self)
+    
+    def clear_thumbnail_index(self, instance, **kwargs):
+        from photoprocessor.models import ThumbnailIndex
+        ThumbnailIndex.objects.clear(instance, self)
+    
+    def compile_pipelines(self):
+        """
+        Resolves the processors of every thumbnail spec once so that
+        configuration errors surface at startup rather than mid-request.
+        """
+        pipelines = dict()
+        for key in self.thumbnails:
+            try:
+                pipelines[key] = Pipeline(self.get_spec(key))
+            except ImproperlyConfigured, e:
+                raise ImproperlyConfigured("%s.%s thumbnail '%s': %s"
+                                           % (self.model.__name__, self.name, key, e))
+        return pipelines
+    
+    def get_pipeline(self, key):
+        config = self.get_spec(key)
+        pipeline = self.pipelines.get(key)
+        if pipeline is None or not pipeline.matches(config):
+            #thumbnails were changed after setup
+            pipeline = self.pipelines[key] = Pipeline(config)
+        return pipeline
+    
+    def is_current(self, data, key):
+        """
+        Returns True if the thumbnail for key in the field data was produced
+        by the current spec.
+        """
+        thumb = data.get(key)
+        if not thumb:
+            return False
+        pipeline = self.get_pipeline(key)
+        if 'fingerprint' in thumb:
+            return thumb['fingerprint'] == pipeline.fingerprint
+        return pipeline.matches(thumb.get('config'))
+    
+    def get_spec(self, key):
+        """ The config of thumbnail key with the field wide defaults applied """
+        config = self.thumbnails[key]
+        if self.metadata is not None and 'metadata' not in config:
+            config = dict(config, metadata=self.metadata)
+        return config
+    
+    def get_proxy_options(self):
+        """ proxy as a dict, proxy=2048 is short for {'size':2048} """
+        if isinstance(self.proxy, dict):
+            return self.proxy
+        return {'size':self.proxy}
+    
+    def get_proxy_pipeline(self):
+        if self._proxy_pipeline is None:
+            options = self.get_proxy_options()
+            size = options['size']
+            config = {'resize':{'width':size, 'height':size, 'crop':'scale'},
+                      'quality':options.get('quality', 95),
+                      #keep the EXIF orientation and colour profile for the specs
+                      'metadata':{'profile':'keep'}}
+            self._proxy_pipeline = Pipeline(config)
+        return self._proxy_pipeline
+    
+    def get_info_pipeline(self):
+        config = self.get_info_spec()
+        if self._info_pipeline is None or not self._info_pipeline.matches(config):
+            self._info_pipeline = Pipeline(config)
+        return self._info_pipeline
+    
+    def get_info_spec(self):
+        """ The config used to build the info of the original """
+        config = dict()
+        if self.metadata is not None:
+            config['metadata'] = self.metadata
+            if self.metadata.get('exif'):
+                config['exif'] = self.metadata['exif']
+        if self.placeholder:
+            config['placeholder'] = self.placeholder
+        for spec in self.thumbnails.values():
+            if spec.get('resize', {}).get('crop') == 'smart':
+                config['focal_point'] = True
+                break
+        return config
+    
+    def get_paths(self, value):
+        """
+        Returns every storage path referenced by a stored value of this field,
+        whether given as JSON or as decoded data.
+        """
+        if isinstance(value, basestring):
+            data = self.loads(value)
+            if data is None:
+                #old style, the value is the path of the original
+                return value and [value] or []
+        else:
+            data = value or {}
+        paths = list()
+        for image in data.values():
+            if isinstance(image, basestring):
+                paths.append(image)
+            elif isinstance(image, dict) and image.get('path'):
+                paths.append(image['path'])
+        return paths
+    
+    def is_isolated(self):
+        """ Whether pixel work runs in child processes, see isolation.py """
+        if self.isolated is None:
+            from settings import ISOLATION
+            return bool(ISOLATION)
+        return self.isolated
+    
+    def get_storage_writer(self):
+        """
+        A StorageWriter when thumbnail uploads should overlap with
+        processing, otherwise None.
+        """
+        max_pending = self.write_behind
+        if max_pending is None:
+            from settings import WRITE_BEHIND
+            max_pending = WRITE_BEHIND
+        if max_pending:
+            return StorageWriter(self.storage, max_pending)
+        return None
+    
+    def get_static_directory(self):
+        """
+        The part of upload_to that does not depend on the date, None when
+        that is the root of the storage.
+        """
+        prefix = self.upload_to.split('%', 1)[0]
+        if '%' in self.upload_to:
+            prefix = os.path.dirname(prefix)
+        directory = prefix and os.path.normpath(prefix)
+        if not directory or directory in (os.curdir, os.sep):
+            return None
+        return directory
+    
+    def content_addressed_name(self, digest, pipeline, ext):
+        """
+        A name derived only from the source content and the spec, so the
+        same thumbnail always lands at the same path.
+        """
+        name = hashlib.sha1('%s:%s' % (digest, pipeline.fingerprint)).hexdigest()
+        return os.path.join(self.get_static_directory() or '', 'cache', name[:2], name[2:4], name + ext)
+    
+    def get_file_cache_name(self):
+        return '_%s_file_cache' % self.name
     
     def get_directory_name(self):
         return os.path.normpath(force_unicode(datetime.datetime.now().strftime(smart_str(self.upload_to))))
@@ -380,6 +1112,30 @@ class ImageWithProcessorsField(JSONField):
     def generate_filename(self, instance, filename):
         return os.path.join(self.get_directory_name(), self.get_filename(filename))
     
+    def validate_image(self, content):
+        """
+        Checks the header of the uploaded content against the configured
+        limits without decoding any pixel data. Returns (format, (width, height))
+        or raises a ValidationError.
+        """
+        try:
+            format, size = sniff_image(content)
+        except IOError:
+            raise ValidationError("Upload a valid image. The file you uploaded was either not an image or a corrupted image.")
+        width, height = size
+        if self.allowed_formats is not None and format not in self.allowed_formats:
+            raise ValidationError("Unsupported image format %s. Allowed formats are: %s."
+                                  % (format, ', '.join(self.allowed_formats)))
+        if self.max_dimensions is not None:
+            max_width, max_height = self.max_dimensions
+            if (max_width and width > max_width) or (max_height and height > max_height):
+                raise ValidationError("Image dimensions %sx%s exceed the maximum of %sx%s."
+                                      % (width, height, max_width or '*', max_height or '*'))
+        if self.max_pixels is not None and width * height > self.max_pixels:
+            raise ValidationError("Image has %s pixels, the maximum is %s."
+                                  % (width * height, self.max_pixels))
+        return format, size
+    
     def save_form_data(self, instance, data):
         # Important: None means "no change", other false value means "clear"
         # This subtle distinction (rather than a more explicit marker) is
@@ -394,7 +1150,8 @@ class ImageWithProcessorsField(JSONField):
         from django.contrib.admin import widgets
         if 'widget' in kwargs and kwargs['widget'] == widgets.AdminTextareaWidget:
             kwargs['widget'] = widgets.AdminFileWidget
-        defaults = {'form_class': forms.FileField, 'max_length': self.max_length, 'widget':forms.FileField.widget}
+        from forms import ImageWithProcessorsFormField
+        defaults = {'form_class': ImageWithProcessorsFormField, 'max_length': self.max_length, 'widget':forms.FileField.widget}
         # If a file has been provided previously, then the form doesn't require
         # that a new file is provided this time.
         # The code to mark the form field as not required is used by
@@ -403,6 +1160,8 @@ class ImageWithProcessorsField(JSONField):
         if 'initial' in kwargs:
             defaults['required'] = False
         defaults.update(kwargs)
+        if issubclass(defaults['form_class'], ImageWithProcessorsFormField):
+            defaults['model_field'] = self
         #print defaults
         return super(ImageWithProcessorsField, self).formfield(**defaults)
 
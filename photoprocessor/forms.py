@@ -0,0 +1,19 @@
+from django import forms
+
+
+class ImageWithProcessorsFormField(forms.FileField):
+    """
+    A file form field that checks the image header against the limits of
+    the model field before the upload is accepted.
+    """
+    def __init__(self, *args, **kwargs):
+        self.model_field = kwargs.pop('model_field', None)
+        super(ImageWithProcessorsFormField, self).__init__(*args, **kwargs)
+    
+    def to_python(self, data):
+        f = super(ImageWithProcessorsFormField, self).to_python(data)
+        if f is None:
+            return None
+        if self.model_field is not None:
+            self.model_field.validate_image(f)
+        return f
@@ -0,0 +1,94 @@
+"""
+Runs decoding, processing and encoding in a pool of recycled child
+processes so that the memory PIL fragments, or a pathological image that
+hangs, never affects the calling (web) process. Enabled with the
+PHOTO_ISOLATION setting or ImageWithProcessorsField(isolated=True).
+"""
+from __future__ import with_statement
+import sys
+import threading
+from cStringIO import StringIO
+
+_pool = None
+_lock = threading.Lock()
+
+
+class ProcessingError(Exception):
+    """ Isolated processing timed out or exceeded its memory limit """
+
+
+def _init_worker(memory_limit):
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def _render(source, config, seed=None):
+    """ Child side: decode source, apply config and encode the result """
+    from lib import Image
+    from processors import Pipeline
+    from utils import img_to_fobj
+    img, info = Pipeline(config).process(Image.open(StringIO(source)), seed)
+    return img_to_fobj(img, info).read(), info
+
+
+def _info(source, config, threshold=None):
+    from lib import Image
+    from processors import Pipeline
+    return Pipeline(config).process_info(Image.open(StringIO(source)), threshold)
+
+
+class IsolatedPool(object):
+    def __init__(self, processes=None, timeout=60, memory_limit=None, max_jobs_per_child=None):
+        self.processes = processes
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.max_jobs_per_child = max_jobs_per_child
+        self.pool = None
+        self.lock = threading.Lock()
+    
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                #imported here, multiprocessing is only needed once isolation is used
+                import multiprocessing
+                kwargs = {'initializer':_init_worker, 'initargs':(self.memory_limit,)}
+                if sys.version_info >= (2, 7):
+                    kwargs['maxtasksperchild'] = self.max_jobs_per_child
+                self.pool = multiprocessing.Pool(self.processes, **kwargs)
+            return self.pool
+    
+    def terminate(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.terminate()
+    
+    def run(self, func, *args):
+        from multiprocessing import TimeoutError
+        result = self.get_pool().apply_async(func, args)
+        try:
+            return result.get(self.timeout)
+        except TimeoutError:
+            #the child may be stuck for good, replace the whole pool
+            self.terminate()
+            raise ProcessingError("Image processing timed out after %s seconds" % self.timeout)
+        except MemoryError:
+            raise ProcessingError("Image processing exceeded the memory limit of %s bytes" % self.memory_limit)
+    
+    def render(self, source, config, seed=None):
+        """ Returns the encoded bytes and info of source processed with config """
+        return self.run(_render, source, config, seed)
+    
+    def info(self, source, config, threshold=None):
+        return self.run(_info, source, config, threshold)
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                from settings import ISOLATION
+                _pool = IsolatedPool(**(ISOLATION or {}))
+    return _pool
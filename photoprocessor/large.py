@@ -0,0 +1,152 @@
+"""
+Bounded memory decoding for very large originals. When every processor up
+to the resize can work on a downscaled source, the source is decoded
+straight into a reduced image instead of being loaded and copied at full
+size: JPEGs through the decoder's DCT scaling, striped, tiled and raw
+formats (TIFF, BMP, PPM, ...) one band of rows at a time. Peak memory then
+follows the reduced size plus one band. The info of the original is read
+the same way: size, format and metadata from the header, the pixels the
+focal point and placeholder look at from a reduced decode. Applies to
+sources above the PHOTO_LARGE_IMAGE_PIXELS setting.
+"""
+import math
+
+from lib import Image
+from settings import LARGE_IMAGE_PIXELS
+
+#modes that can be resized band by band and pasted back together
+BAND_MODES = ('L', 'RGB', 'RGBA', 'CMYK')
+#minimum number of source rows decoded at once
+BAND_ROWS = 64
+#bytes per pixel of the raw modes whose rows can be addressed directly
+RAW_BYTES = {'L':1, 'RGB':3, 'BGR':3, 'RGBA':4, 'RGBX':4, 'BGRX':4, 'CMYK':4}
+
+
+def is_large(size, threshold=None):
+    if threshold is None:
+        threshold = LARGE_IMAGE_PIXELS
+    return bool(threshold) and size[0] * size[1] > threshold
+
+def reduced_size(size, scale):
+    return tuple([max(1, int(math.ceil(value * scale))) for value in size])
+
+def prepare_source(image, pipeline, threshold=None):
+    """
+    Returns the decoded image pipeline should process: a copy of image, or
+    for a large source a reduced image no smaller than the pipeline needs.
+    image itself is never modified so it can be shared between specs.
+    """
+    if not is_large(image.size, threshold):
+        return image.copy()
+    scale = pipeline.required_scale(image.size)
+    if scale is None:
+        return image.copy()
+    size = reduced_size(image.size, scale)
+    if not getattr(image, 'tile', None) or getattr(image, 'fp', None) is None:
+        #already decoded, at least skip the full size copy
+        reduced = image.resize(size, Image.ANTIALIAS)
+    else:
+        reduced = decode_reduced(image, size)
+    reduced.info = dict(image.info)
+    reduced.format = image.format
+    return reduced
+
+def prepare_info_source(image, edge, threshold=None):
+    """
+    The decoded image for info processors that need edge pixels along the
+    longest side: image itself, or for a large source a reduced decode that
+    leaves image undecoded for the specs.
+    """
+    if not is_large(image.size, threshold) or max(image.size) <= edge:
+        return image
+    if not getattr(image, 'tile', None) or getattr(image, 'fp', None) is None:
+        return image
+    reduced = decode_reduced(image, reduced_size(image.size, float(edge) / max(image.size)))
+    reduced.info = dict(image.info)
+    reduced.format = image.format
+    return reduced
+
+def reopen(image):
+    """ A fresh, undecoded image read from the same file as image """
+    image.fp.seek(0)
+    return Image.open(image.fp)
+
+def decode_reduced(image, size):
+    if image.format == 'JPEG':
+        img = reopen(image)
+        #let the decoder scale by 1/2, 1/4 or 1/8 while decoding
+        img.draft(img.mode, size)
+        img.load()
+        if img.size != size:
+            img = img.resize(size, Image.ANTIALIAS)
+        return img
+    tiles = image.tile
+    if image.mode in BAND_MODES and len(tiles) == 1 and tiles[0][0] == 'raw':
+        tiles = split_raw(tiles[0], BAND_ROWS)
+    if image.mode in BAND_MODES and len(tiles) > 1:
+        return decode_bands(image, tiles, size)
+    #a single compressed stream, nothing to bound
+    return image.resize(size, Image.ANTIALIAS)
+
+def split_raw(tile, rows):
+    """ Splits an uncompressed tile into strips of rows """
+    codec, (x0, y0, x1, y1), offset, args = tile
+    if not isinstance(args, tuple):
+        args = (args,)
+    rawmode = args[0]
+    stride = len(args) > 1 and args[1] or 0
+    orientation = len(args) > 2 and args[2] or 1
+    if not stride:
+        if rawmode not in RAW_BYTES:
+            return [tile]
+        stride = (x1 - x0) * RAW_BYTES[rawmode]
+    strips = list()
+    for top in range(y0, y1, rows):
+        bottom = min(top + rows, y1)
+        if orientation < 0: #stored bottom up
+            start = offset + (y1 - bottom) * stride
+        else:
+            start = offset + (top - y0) * stride
+        strips.append((codec, (x0, top, x1, bottom), start, (rawmode, stride, orientation)))
+    return strips
+
+def bands(tiles, rows):
+    """
+    Groups tiles into full width bands of at least rows rows, yielding
+    (top, bottom, tiles) in order.
+    """
+    by_row = dict()
+    for tile in tiles:
+        by_row.setdefault(tile[1][1], list()).append(tile)
+    band, top = list(), None
+    for y in sorted(by_row.keys()):
+        if top is None:
+            top = y
+        band.extend(by_row[y])
+        bottom = max([tile[1][3] for tile in band])
+        if bottom - top >= rows:
+            yield top, bottom, band
+            band, top = list(), None
+    if band:
+        yield top, max([tile[1][3] for tile in band]), band
+
+def decode_bands(image, tiles, size):
+    width, height = image.size
+    scale_y = float(size[1]) / height
+    #every band yields at least two output rows to keep seams soft
+    rows = max(BAND_ROWS, int(math.ceil(2 / scale_y)))
+    reduced = Image.new(image.mode, size)
+    for top, bottom, band_tiles in bands(tiles, rows):
+        out_top, out_bottom = int(round(top * scale_y)), int(round(bottom * scale_y))
+        if out_bottom <= out_top:
+            continue
+        band = reopen(image)
+        try:
+            band.size = (width, bottom - top)
+        except AttributeError: #read-only in newer PIL releases
+            band._size = (width, bottom - top)
+        band.tile = [(codec, (x0, y0 - top, x1, y1 - top), offset, args)
+                     for codec, (x0, y0, x1, y1), offset, args in band_tiles]
+        band.load()
+        reduced.paste(band.resize((size[0], out_bottom - out_top), Image.ANTIALIAS), (0, out_top))
+    return reduced
@@ -1,19 +1,61 @@
 # Required PIL classes may or may not be available from the root namespace
 # depending on the installation method used.
+#
+# PIL is only imported on first attribute access so that processes which
+# merely render stored thumbnail urls never pay for loading it.
 try:
-    import Image
-    import ImageFile
-    import ImageFilter
-    import ImageEnhance
-    import ImageChops
-    import ImageColor
+    import importlib
 except ImportError:
+    from django.utils import importlib
+
+
+def _import_pil(name):
     try:
-        from PIL import Image
-        from PIL import ImageFile
-        from PIL import ImageFilter
-        from PIL import ImageEnhance
-        from PIL import ImageChops
-        from PIL import ImageColor
+        return importlib.import_module(name)
     except ImportError:
-        raise ImportError('Photoprocessor was unable to import the Python Imaging Library. Please confirm it`s installed and available on your current Python path.')
+        try:
+            return importlib.import_module('PIL.%s' % name)
+        except ImportError:
+            raise ImportError('Photoprocessor was unable to import the Python Imaging Library. Please confirm it`s installed and available on your current Python path.')
+
+
+class LazyModule(object):
+    """ Stands in for a PIL module until one of its attributes is used """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = _import_pil(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+
+Image = LazyModule('Image')
+ImageFile = LazyModule('ImageFile')
+ImageFilter = LazyModule('ImageFilter')
+ImageEnhance = LazyModule('ImageEnhance')
+ImageChops = LazyModule('ImageChops')
+ImageColor = LazyModule('ImageColor')
+ExifTags = LazyModule('ExifTags')
+JpegImagePlugin = LazyModule('JpegImagePlugin')
+# colour management is an optional part of PIL, see processors.Metadata
+ImageCms = LazyModule('ImageCms')
+
+MODULES = [Image, ImageFile, ImageFilter, ImageEnhance, ImageChops, ImageColor, ExifTags, JpegImagePlugin]
+
+
+def load():
+    """ Imports PIL right away, e.g. to warm a worker before forking """
+    for module in MODULES:
+        module._load()
+
+
+def is_loaded():
+    return Image._module is not None
@@ -0,0 +1,109 @@
+from optparse import make_option
+import datetime
+import os
+
+from django.core.management.base import BaseCommand
+
+from photoprocessor.fields import ImageWithProcessorsField
+from photoprocessor.utils import map_in_threads
+
+class Command(BaseCommand):
+    help = """Delete files under the upload_to directories of your image fields
+that are no longer referenced by any image or file field"""
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only list the files that would be deleted'),
+        make_option('--grace',
+            type='int',
+            dest='grace',
+            default=24,
+            help='Leave files modified within this many hours alone (default 24)'),
+        make_option('--batch-size',
+            type='int',
+            dest='batch_size',
+            default=100,
+            help='Number of files deleted per batch (default 100)'),
+    )
+    args = '[appname.modelname ...]'
+
+    def handle(self, *args, **kwargs):
+        from django.db import models
+        from photoprocessor.settings import DELETE_WORKERS
+        accepted_models = set([arg.lower() for arg in args])
+        
+        #every field contributes references, only the selected ones are swept
+        referenced = set()
+        directories = dict()
+        deduplicated = list()
+        for model in models.get_models():
+            name = ('%s.%s' % (model._meta.app_label, model._meta.object_name)).lower()
+            for field in model._meta.local_fields:
+                if isinstance(field, models.FileField):
+                    #other file fields may upload to the same directories
+                    values = model._default_manager.exclude(**{field.attname:''}).values_list(field.attname, flat=True)
+                    referenced.update(values.iterator())
+                    continue
+                if not isinstance(field, ImageWithProcessorsField):
+                    continue
+                for value in model._default_manager.values_list(field.attname, flat=True).iterator():
+                    referenced.update(field.get_paths(value))
+                if field.deduplicate:
+                    deduplicated.append(field)
+                if accepted_models and name not in accepted_models:
+                    continue
+                directory = field.get_static_directory()
+                if not directory:
+                    #never sweep the root of a storage
+                    print "Skipping %s.%s, upload_to %r has no fixed directory" % (model.__name__, field.name, field.upload_to)
+                    continue
+                directories.setdefault((id(field.storage), directory), (field.storage, directory))
+        
+        if deduplicated:
+            #shared originals and thumbnails stay while any object holds them
+            from photoprocessor.models import SharedImage, field_label
+            deduplicated = dict([(field_label(field), field) for field in deduplicated])
+            entries = SharedImage.objects.filter(field__in=deduplicated.keys())
+            for label, value in entries.values_list('field', 'data').iterator():
+                referenced.update(deduplicated[label].get_paths(value))
+        
+        cutoff = datetime.datetime.now() - datetime.timedelta(hours=kwargs['grace'])
+        batch_size = kwargs['batch_size']
+        total = 0
+        for storage, directory in directories.values():
+            batch = list()
+            for path in self.walk(storage, directory):
+                if path in referenced or storage.modified_time(path) > cutoff:
+                    continue
+                batch.append(path)
+                if len(batch) >= batch_size:
+                    total += self.delete_batch(storage, batch, kwargs['dry_run'], DELETE_WORKERS)
+                    batch = list()
+            if batch:
+                total += self.delete_batch(storage, batch, kwargs['dry_run'], DELETE_WORKERS)
+        if kwargs['dry_run']:
+            print "%s unreferenced files would be deleted" % total
+        else:
+            print "Deleted %s unreferenced files" % total
+    
+    def walk(self, storage, directory):
+        """ Yields the files below directory one listing at a time """
+        try:
+            dirs, files = storage.listdir(directory)
+        except OSError:
+            return
+        for name in files:
+            yield os.path.join(directory, name)
+        for name in dirs:
+            for path in self.walk(storage, os.path.join(directory, name)):
+                yield path
+    
+    def delete_batch(self, storage, batch, dry_run, workers):
+        if dry_run:
+            for path in batch:
+                print path
+        else:
+            map_in_threads(storage.delete, batch, workers)
+        return len(batch)
@@ -1,8 +1,11 @@
 from optparse import make_option
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from photoprocessor.fields import ImageWithProcessorsField
 
+#rough size of an encoded thumbnail, used when no filesize has been recorded
+ESTIMATED_BYTES_PER_PIXEL = 0.3
+
 class Command(BaseCommand):
     help = """Reprocess the photos on your models"""
     option_list = BaseCommand.option_list + (
@@ -11,6 +14,26 @@ class Command(BaseCommand):
             dest='force',
             default=False,
             help='Force the reprocessing'),
+        make_option('--stale',
+            action='store_true',
+            dest='stale',
+            default=False,
+            help='Only reprocess the objects the thumbnail index reports as stale or missing'),
+        make_option('--rebuild-index',
+            action='store_true',
+            dest='rebuild_index',
+            default=False,
+            help='Rebuild the thumbnail index instead of reprocessing'),
+        make_option('--plan',
+            action='store_true',
+            dest='plan',
+            default=False,
+            help='Report the work a reprocess would do without decoding any images'),
+        make_option('--placeholders',
+            action='store_true',
+            dest='placeholders',
+            default=False,
+            help='Only backfill missing placeholders and dominant colors'),
     )
     args = '[appname.modelname ...]'
 
@@ -24,16 +47,158 @@ class Command(BaseCommand):
                 name = name.lower()
                 if name not in accepted_models:
                     continue
+            image_fields = list()
             for field in model._meta.local_fields:
-                image_fields = list()
                 if isinstance(field, ImageWithProcessorsField):
                     image_fields.append(field.name)
-                if image_fields:
-                    print "Processing %s with fields: %s" % (model, image_fields)
-                    self.reprocess_model(model, image_fields, kwargs['force'])
+            if not image_fields:
+                continue
+            if kwargs['plan']:
+                self.plan_model(model, image_fields, kwargs['force'])
+            elif kwargs['placeholders']:
+                self.backfill_placeholders(model, image_fields, kwargs['force'])
+            elif kwargs['rebuild_index']:
+                self.rebuild_index(model, image_fields)
+            elif kwargs['stale']:
+                queryset = self.stale_objects(model, image_fields)
+                print "Processing %s stale objects of %s with fields: %s" % (queryset.count(), model, image_fields)
+                self.reprocess_model(model, image_fields, kwargs['force'], queryset)
+            else:
+                print "Processing %s with fields: %s" % (model, image_fields)
+                self.reprocess_model(model, image_fields, kwargs['force'])
     
-    def reprocess_model(self, model, fields, force=False):
-        for instance in model.objects.all():
+    def stale_objects(self, model, fields):
+        from photoprocessor.models import ThumbnailIndex
+        pks = set()
+        for field_name in fields:
+            field = model._meta.get_field(field_name)
+            if not field.thumbnail_index:
+                raise CommandError("%s.%s does not maintain a thumbnail index" % (model.__name__, field_name))
+            pks.update(ThumbnailIndex.objects.stale(model, field_name).values_list('object_id', flat=True))
+            for key in field.thumbnails:
+                pks.update(ThumbnailIndex.objects.missing(model, field_name, key).values_list('pk', flat=True))
+        return model.objects.filter(pk__in=pks)
+    
+    def load_data(self, field, value):
+        if not value:
+            return None
+        data = field.loads(value)
+        if data is None: #old style, a bare path
+            data = {'original':{'path':value}}
+        original = data.get('original')
+        if isinstance(original, basestring):
+            data['original'] = {'path':original}
+        if not data.get('original', {}).get('path'):
+            return None
+        return data
+    
+    def plan_model(self, model, fields, force=False):
+        """
+        Reads only the stored field data and reports, per spec, how many
+        thumbnails are stale or missing along with the source megapixels that
+        would be decoded and an estimate of the bytes that would be written.
+        """
+        for field_name in fields:
+            field = model._meta.get_field(field_name)
+            keys = sorted(field.thumbnails.keys())
+            counts = dict([(key, {'current':0, 'stale':0, 'missing':0}) for key in keys])
+            recorded = dict([(key, [0, 0]) for key in keys])
+            pending = dict([(key, list()) for key in keys])
+            objects = megapixels = unknown = 0
+            rows = model._default_manager.values_list('pk', field.attname).iterator()
+            for pk, value in rows:
+                data = self.load_data(field, value)
+                if data is None:
+                    continue
+                work = list()
+                for key in keys:
+                    thumb = data.get(key)
+                    filesize = thumb and thumb.get('info', {}).get('filesize')
+                    if filesize:
+                        recorded[key][0] += filesize
+                        recorded[key][1] += 1
+                    if not thumb:
+                        status = 'missing'
+                    elif force or not field.is_current(data, key):
+                        status = 'stale'
+                    else:
+                        status = 'current'
+                    counts[key][status] += 1
+                    if status != 'current':
+                        work.append(key)
+                        pending[key].append(data['original'].get('info', {}).get('size'))
+                if work:
+                    objects += 1
+                    size = self.source_size(field, data, work, force)
+                    if size:
+                        megapixels += size['width'] * size['height'] / 1000000.0
+                    else:
+                        unknown += 1
+            
+            print "%s.%s: %s objects to process, %.1f source megapixels" % (model.__name__, field_name, objects, megapixels)
+            if unknown:
+                print "  %s sources have no recorded size" % unknown
+            total = 0
+            for key in keys:
+                estimate = self.estimate_bytes(field.get_pipeline(key), pending[key], recorded[key])
+                total += estimate
+                print "  %s: %s current, %s stale, %s missing, ~%s to write" % (key,
+                    counts[key]['current'], counts[key]['stale'], counts[key]['missing'], format_bytes(estimate))
+            print "  total: ~%s to write" % format_bytes(total)
+    
+    def source_size(self, field, data, keys, force=False):
+        """ The size of what reprocessing keys decodes, the proxy when it serves all of them """
+        size = data['original'].get('info', {}).get('size')
+        if field.proxy and not force and data.get('proxy'):
+            field_file = field.attr_class(None, field, data)
+            for key in keys:
+                if not field_file.proxy_satisfies(field.get_pipeline(key)):
+                    return size
+            return data['proxy'].get('info', {}).get('size') or size
+        return size
+    
+    def estimate_bytes(self, pipeline, sizes, recorded):
+        total, count = recorded
+        if count:
+            return int(total / count * len(sizes))
+        estimate = 0
+        for size in sizes:
+            if size:
+                width, height = pipeline.predict_size((size['width'], size['height']))
+                estimate += width * height * ESTIMATED_BYTES_PER_PIXEL
+        return int(estimate)
+    
+    def backfill_placeholders(self, model, fields, force=False):
+        fields = [name for name in fields if model._meta.get_field(name).placeholder]
+        if not fields:
+            return
+        print "Backfilling placeholders of %s with fields: %s" % (model, fields)
+        deferred = 0
+        for instance in model._default_manager.all().iterator():
+            updated = False
+            for field_name in fields:
+                val = getattr(instance, field_name, None)
+                if val and (force or 'placeholder' not in val.image_data.get('info', {})):
+                    if val.reprocess_placeholder(save=False) is None:
+                        updated = True
+                    else:
+                        deferred += 1
+            if updated:
+                instance.save()
+        if deferred:
+            print "  %s placeholders deferred by the admission budget, run again to fill them" % deferred
+    
+    def rebuild_index(self, model, fields):
+        from photoprocessor.models import ThumbnailIndex
+        for field_name in fields:
+            if model._meta.get_field(field_name).thumbnail_index:
+                print "Indexing %s.%s" % (model.__name__, field_name)
+                ThumbnailIndex.objects.rebuild(model, field_name)
+    
+    def reprocess_model(self, model, fields, force=False, queryset=None):
+        if queryset is None:
+            queryset = model.objects.all()
+        for instance in queryset:
             updated = False
             for field_name in fields:
                 val = getattr(instance, field_name, None)
@@ -43,3 +208,10 @@ class Command(BaseCommand):
             if updated:
                 instance.save()
 
+
+def format_bytes(value):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if value < 1024:
+            return '%.1f%s' % (value, unit)
+        value /= 1024.0
+    return '%.1fTB' % value
@@ -0,0 +1,155 @@
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q
+from django.utils import simplejson
+from django.contrib.contenttypes.models import ContentType
+
+
+class ThumbnailIndexManager(models.Manager):
+    def for_field(self, model, field_name):
+        content_type = ContentType.objects.get_for_model(model)
+        return self.filter(content_type=content_type, field_name=field_name)
+    
+    def stale(self, model, field_name):
+        """ Rows whose spec fingerprint differs from the current spec """
+        field = model._meta.get_field(field_name)
+        query = Q()
+        for key in field.thumbnails:
+            query |= Q(key=key) & ~Q(fingerprint=field.get_pipeline(key).fingerprint)
+        return self.for_field(model, field_name).filter(query)
+    
+    def oversized(self, model, field_name, max_bytes):
+        return self.for_field(model, field_name).filter(filesize__gt=max_bytes)
+    
+    def missing(self, model, field_name, key):
+        """ Objects of model that have no thumbnail for key """
+        indexed = self.for_field(model, field_name).filter(key=key).values('object_id')
+        return model._default_manager.exclude(pk__in=indexed)
+    
+    def sync(self, instance, field):
+        """ Brings the rows of one object's field in line with its data """
+        content_type = ContentType.objects.get_for_model(instance)
+        existing = dict()
+        for row in self.filter(content_type=content_type, object_id=instance.pk, field_name=field.name):
+            existing[row.key] = row
+        field_file = getattr(instance, field.name)
+        for key in field.thumbnails:
+            thumb = field_file.data.get(key)
+            if not thumb:
+                continue
+            size = thumb.get('info', {}).get('size', {})
+            fingerprint = thumb.get('fingerprint')
+            if not fingerprint:
+                #written before fingerprints were recorded
+                fingerprint = field_file.is_current(key) and field.get_pipeline(key).fingerprint or ''
+            values = {'fingerprint':fingerprint,
+                      'width':size.get('width'),
+                      'height':size.get('height'),
+                      'filesize':thumb.get('info', {}).get('filesize'),
+                      'path':thumb['path'],}
+            row = existing.pop(key, None)
+            if row is None:
+                self.create(content_type=content_type, object_id=instance.pk,
+                            field_name=field.name, key=key, **values)
+            elif [getattr(row, name) for name in values] != values.values():
+                self.filter(pk=row.pk).update(**values)
+        if existing:
+            self.filter(pk__in=[row.pk for row in existing.values()]).delete()
+    
+    def rebuild(self, model, field_name):
+        field = model._meta.get_field(field_name)
+        for instance in model._default_manager.all().iterator():
+            self.sync(instance, field)
+    
+    def clear(self, instance, field):
+        content_type = ContentType.objects.get_for_model(instance)
+        self.filter(content_type=content_type, object_id=instance.pk, field_name=field.name).delete()
+
+
+class ThumbnailIndex(models.Model):
+    """
+    One row per (object, field, thumbnail key), maintained by
+    ImageWithProcessorsField(thumbnail_index=True), so that stale, missing
+    or oversized thumbnails can be found with an indexed query.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    field_name = models.CharField(max_length=100)
+    key = models.CharField(max_length=100, db_index=True)
+    fingerprint = models.CharField(max_length=40, db_index=True)
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    filesize = models.PositiveIntegerField(null=True, db_index=True)
+    path = models.CharField(max_length=255)
+    
+    objects = ThumbnailIndexManager()
+    
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'field_name', 'key'),)
+    
+    def __unicode__(self):
+        return self.path
+
+
+def field_label(field):
+    return '%s.%s.%s' % (field.model._meta.app_label, field.model._meta.object_name.lower(), field.name)
+
+
+class SharedImageManager(models.Manager):
+    def acquire(self, field, digest):
+        """
+        Takes a reference on the stored image with this digest and returns
+        its data, or None if the field has not stored that content yet.
+        """
+        entries = self.filter(field=field_label(field), digest=digest)
+        #an entry already released to zero is never revived
+        if not entries.filter(refcount__gt=0).update(refcount=F('refcount') + 1):
+            return None
+        return simplejson.loads(entries.values_list('data', flat=True)[0])
+    
+    def register(self, field, digest, data):
+        """
+        Records data as the stored image for digest with one reference.
+        Returns False if another save registered the same content first.
+        """
+        sid = transaction.savepoint(using=self.db)
+        try:
+            self.create(field=field_label(field), digest=digest,
+                        data=simplejson.dumps(data), refcount=1)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=self.db)
+            return False
+        transaction.savepoint_commit(sid, using=self.db)
+        return True
+    
+    def release(self, field, digest):
+        """
+        Drops one reference. Returns the data of the stored image once the
+        last reference is gone, when its files may be deleted, else None.
+        """
+        entries = self.filter(field=field_label(field), digest=digest)
+        entries.update(refcount=F('refcount') - 1)
+        rows = list(entries.filter(refcount__lte=0).values_list('pk', 'data'))
+        if not rows:
+            return None
+        self.filter(pk__in=[pk for pk, data in rows]).delete()
+        return simplejson.loads(rows[0][1])
+
+
+class SharedImage(models.Model):
+    """
+    An original and the thumbnails made from it, shared by every object of
+    an ImageWithProcessorsField(deduplicate=True) that uploaded the same
+    content. refcount is the number of objects referencing it.
+    """
+    field = models.CharField(max_length=255)
+    digest = models.CharField(max_length=40)
+    data = models.TextField()
+    refcount = models.IntegerField(default=0)
+    
+    objects = SharedImageManager()
+    
+    class Meta:
+        unique_together = (('field', 'digest'),)
+    
+    def __unicode__(self):
+        return self.digest
@@ -3,20 +3,56 @@
 
 
 """
-from lib import Image, ImageEnhance, ImageColor, ImageFilter, ImageChops
-from utils import _compare_entropy
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import simplejson
+
+from lib import Image, ImageEnhance, ImageColor, ImageFilter, ImageChops, ImageCms
+from utils import entropy_box, get_exif, compact_value, RATIONAL_TAGS
+from large import prepare_source, prepare_info_source
+
+import base64
+import copy
+import hashlib
+from cStringIO import StringIO
 
 class ImageProcessor(object):
     """ Base image processor class """
     info_only = False
+    key = None
+    #True if running the processor on a downscaled source gives the same result
+    reducible = False
+
+    def applies(self, config):
+        """ Returns True if the processor has any work to do for the config """
+        return self.key is None or self.key in config
+
+    def validate(self, config):
+        """ Raises ImproperlyConfigured if the config cannot be processed """
+        pass
 
     def process(self, img, config, info):
         return img
 
+    def predict_size(self, config, size):
+        """ The (width, height) process would produce from an image of size """
+        return size
+
+    def get_scale(self, config, size):
+        """ The factor process scales an image of size by, None if it does not """
+        return None
+
+    def info_edge(self, config):
+        """
+        For info processors that look at the pixels, the longest edge they
+        need the image decoded at; None when the header is enough.
+        """
+        return None
+
 
 class Adjustment(ImageProcessor):
     config_vars = ['color', 'brightness', 'contrast', 'sharpness']
     key = 'adjustment'
+    reducible = True
 
     def process(self, img, config, info):
         if config.get(self.key, False):
@@ -32,6 +68,7 @@ class Adjustment(ImageProcessor):
 
 class Format(ImageProcessor):
     config_vars = ['format']
+    key = 'format'
     format = 'JPEG'
     extension = 'jpg'
 
@@ -42,6 +79,7 @@ class Format(ImageProcessor):
 
 class Quality(ImageProcessor):
     config_vars = ['quality']
+    key = 'quality'
 
     def process(self, img, config, info):
         if 'quality' in config:
@@ -58,10 +96,160 @@ class DimensionInfo(ImageProcessor):
 
 class ExtraInfo(ImageProcessor): #CONSIDER this should only be done on the original image
     info_only = True
+    #embedded blobs that do not belong in the json column
+    skip = ['exif', 'icc_profile', 'xmp', 'XML:com.adobe.xmp', 'photoshop', 'iptc', 'adobe', 'adobe_transform']
+    
+    def process(self, img, config, info):
+        extra_info = dict()
+        for name, value in img.info.items():
+            if name in self.skip:
+                continue
+            value = compact_value(value)
+            if value is not None:
+                extra_info[name] = value
+        info['extra_info'] = extra_info
+        return img
+
+class ExifInfo(ImageProcessor):
+    """
+    Records the EXIF tags listed in config['exif'] as compact typed values
+    in info['exif']. Only the info spec of the original sets it, so the
+    tags are stored once per image rather than once per thumbnail.
+    """
+    info_only = True
+    key = 'exif'
+    
+    def applies(self, config):
+        return bool(config.get(self.key))
+    
+    def process(self, img, config, info):
+        if not self.applies(config):
+            return img
+        wanted = config[self.key]
+        exif = dict()
+        for name, value in get_exif(img).items():
+            if name in wanted:
+                value = compact_value(value, rational=name in RATIONAL_TAGS)
+                if value is not None:
+                    exif[name] = value
+        info['exif'] = exif
+        return img
+
+class FocalPoint(ImageProcessor):
+    """
+    Records the most detailed point of the image in info['focal_point'] as
+    fractions of its width and height, found once on a small copy, for
+    every 'smart' crop of the image to centre on.
+    """
+    info_only = True
+    key = 'focal_point'
+    size = 64
+    
+    def applies(self, config):
+        return bool(config.get(self.key))
+    
+    def info_edge(self, config):
+        return self.applies(config) and self.size or None
+    
+    def process(self, img, config, info):
+        if not self.applies(config):
+            return img
+        scale = min(1.0, float(self.size) / max(img.size))
+        size = (max(1, int(round(img.size[0] * scale))), max(1, int(round(img.size[1] * scale))))
+        small = img.resize(size, Image.ANTIALIAS).convert('L')
+        left, top, right, bottom = entropy_box(small, size[0] // 2, size[1] // 2)
+        info[self.key] = {'x':round((left + right) / 2.0 / size[0], 3),
+                          'y':round((top + bottom) / 2.0 / size[1], 3)}
+        return img
+
+class Placeholder(ImageProcessor):
+    """
+    Records a tiny preview of the image as a base64 data uri in
+    info['placeholder'] and its dominant color as '#rrggbb' in
+    info['color'], so pages can inline them while the thumbnail loads.
+    config['placeholder'] is True or {'size':16, 'quality':40}.
+    """
+    info_only = True
+    key = 'placeholder'
+    size = 16
+    quality = 40
+    
+    def applies(self, config):
+        return bool(config.get(self.key))
+    
+    def info_edge(self, config):
+        if not self.applies(config):
+            return None
+        options = config[self.key]
+        if not isinstance(options, dict):
+            options = {}
+        return options.get('size', self.size)
+    
+    def process(self, img, config, info):
+        if not self.applies(config):
+            return img
+        options = config[self.key]
+        if not isinstance(options, dict):
+            options = {}
+        edge = options.get('size', self.size)
+        scale = float(edge) / max(img.size)
+        size = (max(1, int(round(img.size[0] * scale))), max(1, int(round(img.size[1] * scale))))
+        preview = img.resize(size, Image.ANTIALIAS).convert('RGB').filter(ImageFilter.SMOOTH)
+        
+        palette = preview.convert('P', palette=Image.ADAPTIVE, colors=4)
+        count, index = max(palette.getcolors())
+        info['color'] = '#%02x%02x%02x' % tuple(palette.getpalette()[index * 3:index * 3 + 3])
+        
+        buf = StringIO()
+        preview.save(buf, 'JPEG', quality=options.get('quality', self.quality))
+        info['placeholder'] = 'data:image/jpeg;base64,%s' % base64.b64encode(buf.getvalue())
+        return img
+
+class Metadata(ImageProcessor):
+    """
+    Decides what embedded metadata (ICC profile, EXIF, XMP) an output
+    carries, according to config['metadata']['profile']:
+    
+        - strip: drop it all (default)
+        - keep: embed the original's ICC profile and EXIF
+        - convert: convert the pixels to sRGB, then drop it all
+    """
+    key = 'metadata'
+    profile = 'strip'
+    profiles = ('strip', 'keep', 'convert')
+    embedded = ['exif', 'icc_profile', 'xmp', 'XML:com.adobe.xmp', 'photoshop', 'iptc']
+    
+    def validate(self, config):
+        profile = config[self.key].get('profile', self.profile)
+        if profile not in self.profiles:
+            raise ImproperlyConfigured("Unknown metadata profile %r" % profile)
     
     def process(self, img, config, info):
-        info['extra_info'] = img.info
+        if self.key not in config:
+            return img
+        profile = config[self.key].get('profile', self.profile)
+        info['profile'] = profile
+        if profile == 'keep':
+            return img
+        if profile == 'convert' and img.info.get('icc_profile'):
+            img = self.to_srgb(img)
+        for name in self.embedded:
+            img.info.pop(name, None)
         return img
+    
+    def to_srgb(self, img):
+        try:
+            source = ImageCms.ImageCmsProfile(StringIO(img.info['icc_profile']))
+            if img.mode not in ('RGB', 'RGBA', 'CMYK', 'L'):
+                img = img.convert('RGB')
+            output_mode = img.mode == 'RGBA' and 'RGBA' or 'RGB'
+            converted = ImageCms.profileToProfile(img, source, ImageCms.createProfile('sRGB'),
+                                                  outputMode=output_mode)
+        except Exception:
+            #no colour management available or a broken profile, strip only
+            return img
+        converted.info = dict(img.info)
+        return converted
 
 class Reflection(ImageProcessor):
     config_vars = ['background_color', 'size', 'opacity']
@@ -125,6 +313,14 @@ class AutoCrop(ImageProcessor):
         diff = ImageChops.difference(bw, bg)
         bbox = diff.getbbox()
         if bbox:
+            if 'focal_point' in info:
+                #keep the point on the same spot of the cropped image
+                width, height = img.size
+                left, top, right, bottom = bbox
+                point = info['focal_point']
+                info['focal_point'] = {
+                    'x':min(max((point['x'] * width - left) / (right - left), 0.0), 1.0),
+                    'y':min(max((point['y'] * height - top) / (bottom - top), 0.0), 1.0),}
             img = img.crop(bbox)
         return img
 
@@ -134,6 +330,47 @@ class Resize(ImageProcessor):
     key = 'resize'
     crop = False
     upscale = False
+    crop_modes = (None, False, True, 'scale', 'center', 'smart')
+
+    def validate(self, config):
+        config = config[self.key]
+        for var in ('width', 'height'):
+            if var not in config:
+                raise ImproperlyConfigured("resize requires '%s'" % var)
+        if not (config['width'] or config['height']):
+            raise ImproperlyConfigured("resize requires a width or a height")
+        if config.get('crop', self.crop) not in self.crop_modes:
+            raise ImproperlyConfigured("Unknown resize crop %r" % config['crop'])
+
+    def get_scale(self, config, size):
+        if self.key not in config:
+            return None
+        config = config[self.key]
+        crop = config.get('crop', self.crop)
+        source_x, source_y = [float(v) for v in size]
+        target_x, target_y = [float(v) for v in (config['width'], config['height'])]
+        if not crop or crop == 'scale':
+            return min(target_x / source_x, target_y / source_y)
+        return max(target_x / source_x, target_y / source_y)
+
+    def predict_size(self, config, size):
+        scale = self.get_scale(config, size)
+        if scale is None:
+            return size
+        config = config[self.key]
+        crop = config.get('crop', self.crop)
+        source_x, source_y = [float(v) for v in size]
+        target_x, target_y = [float(v) for v in (config['width'], config['height'])]
+        if not target_x:
+            target_x = source_x * scale
+        elif not target_y:
+            target_y = source_y * scale
+        width, height = size
+        if scale < 1.0 or (scale > 1.0 and config.get('upscale', self.upscale)):
+            width, height = int(round(source_x * scale)), int(round(source_y * scale))
+        if crop and crop != 'scale':
+            width, height = min(width, int(target_x)), min(height, int(target_y))
+        return width, height
 
     def process(self, img, config, info):
         if self.key not in config:
@@ -146,11 +383,7 @@ class Resize(ImageProcessor):
         
         source_x, source_y = [float(v) for v in img.size]
         target_x, target_y = [float(v) for v in size]
-        
-        if not crop or crop == 'scale':
-            scale = min(target_x / source_x, target_y / source_y)
-        else:
-            scale = max(target_x / source_x, target_y / source_y)
+        scale = self.get_scale({self.key:config}, img.size)
 
         # Handle one-dimensional targets.
         if not target_x:
@@ -178,26 +411,15 @@ class Resize(ImageProcessor):
                        min(source_x, int(target_x) + halfdiff_x),
                        min(source_y, int(target_y) + halfdiff_y)]
                 #TODO edge crop?
-                if crop == 'smart': #TODO this does not appear to work
-                    left = top = 0
-                    right, bottom = source_x, source_y
-                    while diff_x:
-                        slice = min(diff_x, max(diff_x // 5, 10))
-                        start = img.crop((left, 0, left + slice, source_y))
-                        end = img.crop((right - slice, 0, right, source_y))
-                        add, remove = _compare_entropy(start, end, slice, diff_x)
-                        left += add
-                        right -= remove
-                        diff_x = diff_x - add - remove
-                    while diff_y:
-                        slice = min(diff_y, max(diff_y // 5, 10))
-                        start = img.crop((0, top, source_x, top + slice))
-                        end = img.crop((0, bottom - slice, source_x, bottom))
-                        add, remove = _compare_entropy(start, end, slice, diff_y)
-                        top += add
-                        bottom -= remove
-                        diff_y = diff_y - add - remove
-                    box = (left, top, right, bottom)
+                if crop == 'smart' and 'focal_point' in info:
+                    #centre the window on the point found on the original
+                    point = info['focal_point']
+                    left = int(round(point['x'] * source_x - target_x / 2))
+                    top = int(round(point['y'] * source_y - target_y / 2))
+                    left, top = min(max(left, 0), diff_x), min(max(top, 0), diff_y)
+                    box = (left, top, left + source_x - diff_x, top + source_y - diff_y)
+                elif crop == 'smart': #TODO this does not appear to work
+                    box = entropy_box(img, source_x - diff_x, source_y - diff_y)
                 # Finally, crop the image!
                 img = img.crop(box)
         return img
@@ -233,6 +455,12 @@ class Transpose(ImageProcessor):
 
     method = 'auto'
 
+    def validate(self, config):
+        method = config[self.key].get('method')
+        if method != 'auto' and method not in ['FLIP_LEFT_RIGHT', 'FLIP_TOP_BOTTOM',
+                                               'ROTATE_90', 'ROTATE_180', 'ROTATE_270']:
+            raise ImproperlyConfigured("Unknown transpose method %r" % method)
+
     def process(self, img, config, info):
         if self.key not in config:
             return img
@@ -249,22 +477,115 @@ class Transpose(ImageProcessor):
             img = img.transpose(getattr(Image, method))
         return img
 
-#image is Image.open(afile)
+class Pipeline(object):
+    """
+    The processors that apply to a single spec, resolved and validated once.
+    Pipelines are immutable; the fingerprint identifies the output they
+    produce and is stored alongside each thumbnail.
+    """
+    __slots__ = ('_config', '_processors', '_info_processors', '_fingerprint')
+
+    def __init__(self, config, processors=None):
+        if processors is None:
+            from settings import PROCESSORS
+            processors = PROCESSORS
+        config = copy.deepcopy(config)
+        applied = list()
+        for proc in processors:
+            if proc.info_only or proc.applies(config):
+                proc.validate(config)
+                applied.append(proc)
+        object.__setattr__(self, '_config', config)
+        object.__setattr__(self, '_processors', tuple(applied))
+        object.__setattr__(self, '_info_processors', tuple([proc for proc in applied if proc.info_only]))
+        object.__setattr__(self, '_fingerprint', self._compute_fingerprint())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Pipeline objects are immutable")
+
+    def _compute_fingerprint(self):
+        names = ['%s.%s' % (type(proc).__module__, type(proc).__name__)
+                 for proc in self._processors if not proc.info_only]
+        payload = simplejson.dumps([self._config, names], sort_keys=True)
+        return hashlib.sha1(payload).hexdigest()
+
+    @property
+    def config(self):
+        return copy.deepcopy(self._config)
+
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    @property
+    def processors(self):
+        return self._processors
+
+    def matches(self, config):
+        return self._config == config
+
+    def predict_size(self, size):
+        """ Estimates the output dimensions for a source of the given size """
+        for proc in self._processors:
+            size = proc.predict_size(self._config, size)
+        return size
+
+    def required_scale(self, size):
+        """
+        The factor a source of size may be downscaled by before processing
+        without changing the output, or None if the full source is needed.
+        """
+        for proc in self._processors:
+            if proc.info_only:
+                continue
+            scale = proc.get_scale(self._config, size)
+            if scale is not None:
+                if 0 < scale < 1.0:
+                    return scale
+                return None
+            if not proc.reducible:
+                return None
+        return None
+
+    #image is Image.open(afile)
+    def process(self, image, seed=None):
+        """
+        Returns the processed image and its info. seed holds facts about
+        the original, e.g. its 'focal_point', for the processors to use;
+        they are not part of the returned info.
+        """
+        seed = seed or {}
+        info = dict(seed)
+        info['format'] = image.format
+        img = prepare_source(image, self)
+        for proc in self._processors:
+            img = proc.process(img, self._config, info)
+        img.format = info['format']
+        for key in seed:
+            info.pop(key, None)
+        return img, info
+
+    def process_info(self, image, threshold=None):
+        """
+        Returns the info of image without processing it. Size, format and
+        metadata are read from the header; the processors that look at the
+        pixels share one decode, reduced for a source above threshold pixels
+        (PHOTO_LARGE_IMAGE_PIXELS by default).
+        """
+        info = {'format':image.format}
+        edges = [proc.info_edge(self._config) for proc in self._info_processors]
+        decoded = None
+        for proc, edge in zip(self._info_processors, edges):
+            if edge:
+                if decoded is None:
+                    decoded = prepare_info_source(image, max([edge for edge in edges if edge]), threshold)
+                proc.process(decoded, self._config, info)
+            else:
+                proc.process(image, self._config, info)
+        return info
+
 def process_image(image, config):
-    from settings import PROCESSORS
-    info = {'format':image.format}
-    img = image.copy()
-    for proc in PROCESSORS:
-        img = proc.process(img, config, info)
-    img.format = info['format']
-    return img, info
+    return Pipeline(config).process(image)
 
 def process_image_info(image, config={}):
-    from settings import PROCESSORS
-    info = {'format':image.format}
-    img = image.copy()
-    for proc in PROCESSORS:
-        if proc.info_only:
-            img = proc.process(img, config, info)
-    return info
-
+    return Pipeline(config).process_info(image)
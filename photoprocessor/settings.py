@@ -4,6 +4,40 @@ try:
 except ImportError:
     from django.utils import importlib
 
+#number of concurrent storage.delete calls when removing an image and its thumbnails
+DELETE_WORKERS = getattr(settings, 'PHOTO_DELETE_WORKERS', 4)
+
+#maximum number of thumbnail uploads queued behind processing, 0 saves synchronously
+WRITE_BEHIND = getattr(settings, 'PHOTO_WRITE_BEHIND', 0)
+
+#size of the pool used by asave(), areprocess(), aget() and adelete()
+EXECUTOR_WORKERS = getattr(settings, 'PHOTO_EXECUTOR_WORKERS', 4)
+
+#how the thumbnail view answers: 'redirect' to the storage url or stream the 'file'
+SERVE_MODE = getattr(settings, 'PHOTO_SERVE_MODE', 'redirect')
+SERVE_MAX_AGE = getattr(settings, 'PHOTO_SERVE_MAX_AGE', 60 * 60 * 24)
+#redirects are cached privately and briefly, the storage path they point at
+#changes when the thumbnail is reprocessed or deleted
+SERVE_REDIRECT_MAX_AGE = getattr(settings, 'PHOTO_SERVE_REDIRECT_MAX_AGE', 60)
+
+#run processing in recycled child processes, e.g.
+#{'processes':2, 'timeout':30, 'memory_limit':1024 * 1024 * 1024, 'max_jobs_per_child':20}
+ISOLATION = getattr(settings, 'PHOTO_ISOLATION', None)
+
+#seconds storage.url() results are cached for in the PHOTO_URL_CACHE_ALIAS
+#cache, keep it below the lifetime of signed urls; 0 disables the cache
+URL_CACHE_TIMEOUT = getattr(settings, 'PHOTO_URL_CACHE_TIMEOUT', 0)
+URL_CACHE_ALIAS = getattr(settings, 'PHOTO_URL_CACHE_ALIAS', 'default')
+
+#limits on thumbnails generated inline by field_file[key], e.g.
+#{'concurrent':2, 'host_concurrent':8, 'megapixels_per_second':40,
+# 'max_pixels':30 * 1000 * 1000, 'fallback':'placeholder'}
+ADMISSION = getattr(settings, 'PHOTO_ADMISSION', None)
+
+#sources above this many pixels are decoded band by band into a reduced image
+#when a spec only downscales them, 0 always decodes the full source
+LARGE_IMAGE_PIXELS = getattr(settings, 'PHOTO_LARGE_IMAGE_PIXELS', 40 * 1000 * 1000)
+
 default_processors = [
     'photoprocessor.processors.Adjustment',
     'photoprocessor.processors.AutoCrop',
@@ -11,17 +45,45 @@ default_processors = [
     'photoprocessor.processors.Quality',
     'photoprocessor.processors.Reflection',
     'photoprocessor.processors.Transpose',
+    'photoprocessor.processors.Metadata',
     'photoprocessor.processors.Format',
     'photoprocessor.processors.DimensionInfo',
+    'photoprocessor.processors.ExifInfo',
+    'photoprocessor.processors.FocalPoint',
+    'photoprocessor.processors.Placeholder',
     #'photoprocessor.processors.ExtraInfo',
 ]
 
-PROCESSORS = list()
 
-for entry in getattr(settings, 'PHOTO_PROCESSORS', default_processors):
-    module_name, class_name = entry.rsplit('.', 1)
-    module = importlib.import_module(module_name)
-    obj = getattr(module, class_name)
-    if isinstance(obj, type):
-        obj = obj()
-    PROCESSORS.append(obj)
+class ProcessorRegistry(object):
+    """
+    The instantiated PHOTO_PROCESSORS, imported on first use rather than
+    when this module is imported.
+    """
+    def __init__(self):
+        self._processors = None
+
+    def load(self):
+        if self._processors is None:
+            processors = list()
+            for entry in getattr(settings, 'PHOTO_PROCESSORS', default_processors):
+                module_name, class_name = entry.rsplit('.', 1)
+                module = importlib.import_module(module_name)
+                obj = getattr(module, class_name)
+                if isinstance(obj, type):
+                    obj = obj()
+                processors.append(obj)
+            self._processors = processors
+        return self._processors
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __getitem__(self, index):
+        return self.load()[index]
+
+
+PROCESSORS = ProcessorRegistry()
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+#sent when field_file[key] is over the admission budget and does not generate
+#the thumbnails inline; keys are the thumbnails that are still missing
+thumbnail_deferred = Signal(providing_args=['field_file', 'keys', 'reason'])
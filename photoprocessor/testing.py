@@ -0,0 +1,62 @@
+"""
+A local storage that records the calls made to it and can stand in for a
+remote backend such as S3, shared by the test suite and the benchmarks.
+"""
+from __future__ import with_statement
+import threading
+import time
+
+from django.core.files.storage import FileSystemStorage
+
+
+class RecordingStorage(FileSystemStorage):
+    """
+    Records (method, name) for every call in self.calls.
+    latency: seconds slept on every call
+    fail_on: saves of names containing it raise IOError
+    Saves in flight at once are tracked in max_in_flight.
+    """
+    def __init__(self, location=None, base_url=None, latency=0.0, fail_on=None):
+        super(RecordingStorage, self).__init__(location, base_url)
+        self.latency = latency
+        self.fail_on = fail_on
+        self.calls = list()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def record(self, method, name):
+        self.calls.append((method, name))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _open(self, name, mode='rb'):
+        self.record('open', name)
+        return super(RecordingStorage, self)._open(name, mode)
+
+    def _save(self, name, content):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            self.record('save', name)
+            if self.fail_on and self.fail_on in name:
+                raise IOError('Simulated failure saving %s' % name)
+            return super(RecordingStorage, self)._save(name, content)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def delete(self, name):
+        self.record('delete', name)
+        return super(RecordingStorage, self).delete(name)
+
+    def exists(self, name):
+        self.record('exists', name)
+        return super(RecordingStorage, self).exists(name)
+
+    def size(self, name):
+        self.record('size', name)
+        return super(RecordingStorage, self).size(name)
+
+    #url is computed locally by every backend worth using, so it is free
@@ -1 +1,10 @@
 from processors import *
+from fields import *
+from bulk import *
+from models import *
+from writer import *
+from views import *
+from isolation import *
+from large import *
+from admission import *
+from commands import *
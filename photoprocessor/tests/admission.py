@@ -0,0 +1,121 @@
+from django.utils import unittest
+from django.test import TestCase
+
+from common import image_content, Photo
+
+from photoprocessor import admission
+from photoprocessor.admission import Budget
+from photoprocessor.signals import thumbnail_deferred
+
+class BudgetTestCase(unittest.TestCase):
+    def test_max_pixels(self):
+        budget = Budget(max_pixels=100)
+        self.assertEqual(budget.admit(101), 'too_large')
+        self.assertEqual(budget.admit(100), None)
+        self.assertEqual(budget.counters['deferred_too_large'], 1)
+    
+    def test_concurrency(self):
+        budget = Budget(concurrent=1)
+        self.assertEqual(budget.admit(10), None)
+        self.assertEqual(budget.admit(10), 'concurrency')
+        budget.release()
+        self.assertEqual(budget.admit(10), None)
+    
+    def test_rate(self):
+        budget = Budget(megapixels_per_second=1)
+        self.assertEqual(budget.admit(800000), None)
+        budget.release()
+        self.assertEqual(budget.admit(800000), 'rate')
+    
+    def test_large_source_gets_a_full_bucket(self):
+        budget = Budget(megapixels_per_second=1)
+        self.assertEqual(budget.admit(5000000), None)
+
+class RecordingCache(object):
+    def __init__(self):
+        self.timeouts = dict()
+        self.values = dict()
+
+    def add(self, key, value, timeout=None):
+        self.timeouts[key] = timeout
+        self.values.setdefault(key, value)
+
+    def incr(self, key):
+        self.values[key] += 1
+        return self.values[key]
+
+    def get_many(self, keys):
+        return dict([(key, self.values[key]) for key in keys if key in self.values])
+
+class HostCountersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = RecordingCache()
+        self.budget = Budget(max_pixels=100, counter_window=60)
+        self.budget.get_cache = lambda: self.cache
+        self.time = admission.time.time
+        self.now = 6000.0
+        admission.time.time = lambda: self.now
+
+    def tearDown(self):
+        admission.time.time = self.time
+
+    def test_counters_expire(self):
+        self.budget.admit(101)
+        self.assertEqual(set(self.cache.timeouts.values()), set([120]))
+        self.assertEqual(self.budget.host_counters()['deferred_too_large'], 1)
+
+    def test_counters_restart_every_window(self):
+        self.budget.admit(101)
+        self.now += 59
+        self.budget.admit(101)
+        self.assertEqual(self.budget.host_counters()['deferred'], 2)
+        self.now += 1
+        self.assertEqual(self.budget.host_counters()['deferred'], 0)
+        self.budget.admit(101)
+        self.assertEqual(self.budget.host_counters()['deferred'], 1)
+
+class DeferredGenerationTestCase(TestCase):
+    def setUp(self):
+        self.photo = Photo()
+        self.photo.image.save('photo.png', image_content((60, 40)))
+        del self.photo.image.data['display']
+        self.budget = admission._budget
+        admission._budget = Budget(max_pixels=100, fallback='placeholder')
+        self.deferred = list()
+        thumbnail_deferred.connect(self.receiver)
+    
+    def tearDown(self):
+        admission._budget = self.budget
+        thumbnail_deferred.disconnect(self.receiver)
+    
+    def receiver(self, field_file, keys, reason, **kwargs):
+        self.deferred.append((keys, reason))
+    
+    def test_serves_placeholder(self):
+        from photoprocessor import settings
+        admission_setting = settings.ADMISSION
+        settings.ADMISSION = {'max_pixels':100}
+        try:
+            thumb = self.photo.image['display']
+        finally:
+            settings.ADMISSION = admission_setting
+        self.assertFalse('display' in self.photo.image.data)
+        self.assertEqual(self.deferred, [(['display'], 'too_large')])
+        self.assertEqual((thumb.width(), thumb.height()), (50, 33))
+        self.assertTrue('/display/' in thumb.url)
+    
+    def test_view_is_under_budget(self):
+        from photoprocessor import settings
+        self.photo.save()
+        admission_setting = settings.ADMISSION
+        settings.ADMISSION = {'max_pixels':100}
+        try:
+            url = self.photo.image['display'].url
+            response = self.client.get(url)
+        finally:
+            settings.ADMISSION = admission_setting
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '10')
+        photo = Photo.objects.get(pk=self.photo.pk)
+        self.assertFalse('display' in photo.image.data)
+        self.assertEqual(self.deferred, [(['display'], 'too_large')] * 2)
@@ -0,0 +1,98 @@
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase
+
+from common import image_content, Photo, test_storage
+
+from photoprocessor import urlcache
+from photoprocessor.bulk import resolve_thumbnails, prefetch_urls
+
+class ResolveThumbnailsTestCase(TestCase):
+    def setUp(self):
+        self.photos = list()
+        for i in range(3):
+            photo = Photo()
+            photo.image.save('photo%s.png' % i, image_content((60, 40)))
+            for key in photo.image.field.thumbnails:
+                del photo.image.data[key]
+            photo.save()
+            self.photos.append(photo)
+    
+    def test_generates_missing_in_one_write(self):
+        results = resolve_thumbnails(Photo.objects.all(), 'image', ['thumb', 'display'], workers=2)
+        self.assertEqual(len(results), 3)
+        for obj, thumbs in results:
+            self.assertEqual(thumbs['thumb'].width(), 10)
+            self.assertEqual(thumbs['display'].width(), 50)
+        for photo in Photo.objects.all():
+            self.assertTrue('thumb' in photo.image.data)
+            self.assertTrue('display' in photo.image.data)
+    
+    def test_without_generation(self):
+        results = resolve_thumbnails(self.photos, 'image', ['thumb'], generate=False)
+        for obj, thumbs in results:
+            self.assertFalse(thumbs['thumb'])
+        self.assertFalse('thumb' in Photo.objects.get(pk=self.photos[0].pk).image.data)
+
+
+class PrefetchUrlsTestCase(TestCase):
+    def setUp(self):
+        self.timeout = urlcache.URL_CACHE_TIMEOUT
+        urlcache.URL_CACHE_TIMEOUT = 60
+        urlcache.get_cache().clear()
+        self.resolved = list()
+        def url(name):
+            self.resolved.append(name)
+            return '/signed/%s' % name
+        test_storage.url = url
+        for i in range(2):
+            Photo().image.save('photo%s.png' % i, image_content((60, 40)))
+    
+    def tearDown(self):
+        urlcache.URL_CACHE_TIMEOUT = self.timeout
+        del test_storage.url
+    
+    def test_one_lookup_per_page(self):
+        prefetch_urls(Photo.objects.all(), 'image', ['thumb', 'original'])
+        self.assertEqual(len(self.resolved), 4)
+        self.resolved = list()
+        photos = list(Photo.objects.all())
+        prefetch_urls(photos, 'image', ['thumb', 'original'])
+        self.assertEqual(photos[0].image['thumb'].url, '/signed/%s' % photos[0].image['thumb'].name)
+        self.assertEqual(photos[0].image.url, '/signed/%s' % photos[0].image.name)
+        self.assertEqual(self.resolved, [])
+    
+    def test_remembered_url_expires(self):
+        photo = Photo.objects.all()[0]
+        now = urlcache.time.time()
+        photo.image.url
+        self.assertEqual(self.resolved, [photo.image.name])
+        photo.image.url
+        self.assertEqual(self.resolved, [photo.image.name])
+        urlcache.get_cache().clear()
+        time = urlcache.time.time
+        urlcache.time.time = lambda: now + 61
+        try:
+            photo.image.url
+        finally:
+            urlcache.time.time = time
+        self.assertEqual(self.resolved, [photo.image.name] * 2)
+
+    def test_not_remembered_without_timeout(self):
+        urlcache.URL_CACHE_TIMEOUT = 0
+        photo = Photo.objects.all()[0]
+        photo.image['thumb'].url
+        photo.image['thumb'].url
+        self.assertEqual(self.resolved, [photo.image['thumb'].name] * 2)
+
+    def test_delete_invalidates(self):
+        photo = Photo.objects.all()[0]
+        name = photo.image['thumb'].name
+        photo.image['thumb'].url
+        photo.image.delete()
+        self.assertEqual(urlcache.get_cache().get(urlcache.cache_key(test_storage, name)), None)
+    
+    def test_storages_of_one_class_do_not_share_urls(self):
+        other = FileSystemStorage(location=test_storage.location, base_url='/elsewhere/')
+        self.assertNotEqual(urlcache.cache_key(test_storage, 'a.png'), urlcache.cache_key(other, 'a.png'))
+        self.assertEqual(urlcache.get_url(test_storage, 'a.png'), '/signed/a.png')
+        self.assertEqual(urlcache.get_url(other, 'a.png'), '/elsewhere/a.png')
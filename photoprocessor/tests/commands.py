@@ -0,0 +1,170 @@
+from StringIO import StringIO
+import os
+import sys
+import time
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import TestCase
+
+from common import image_content, test_storage, recording_storage, Photo, RecordingPhoto, Attachment
+
+from photoprocessor.fields import ImageWithProcessorsField
+from photoprocessor.management.commands.reprocess_photos import Command as ReprocessCommand, format_bytes
+
+def age_files(storage, hours=48):
+    """ Sets the modification time of every file in storage hours back """
+    then = time.time() - hours * 3600
+    for root, dirs, files in os.walk(storage.location):
+        for name in files:
+            os.utime(os.path.join(root, name), (then, then))
+
+def capture(func, *args, **kwargs):
+    """ Runs func and returns what it printed """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        func(*args, **kwargs)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+def cleanup(*args, **kwargs):
+    capture(call_command, 'cleanup_photos', *args, **kwargs)
+
+class CleanupPhotosTestCase(TestCase):
+    def setUp(self):
+        self.photo = Photo()
+        self.photo.image.save('photo.png', image_content((60, 40)))
+        self.orphan = test_storage.save('photos/orphan.png', image_content())
+    
+    def test_deletes_unreferenced_files(self):
+        age_files(test_storage)
+        cleanup('photoprocessor.photo')
+        self.assertFalse(test_storage.exists(self.orphan))
+        for path in self.photo.image.field.get_paths(self.photo.image.data):
+            self.assertTrue(test_storage.exists(path))
+    
+    def test_dry_run(self):
+        age_files(test_storage)
+        cleanup('photoprocessor.photo', dry_run=True)
+        self.assertTrue(test_storage.exists(self.orphan))
+    
+    def test_grace_period(self):
+        cleanup('photoprocessor.photo', grace=1)
+        self.assertTrue(test_storage.exists(self.orphan))
+        age_files(test_storage, hours=2)
+        cleanup('photoprocessor.photo', grace=1)
+        self.assertFalse(test_storage.exists(self.orphan))
+    
+    def test_keeps_files_of_other_file_fields(self):
+        attachment = Attachment()
+        attachment.document.save('notes.txt', ContentFile('notes'))
+        age_files(test_storage)
+        cleanup('photoprocessor.photo')
+        self.assertTrue(test_storage.exists(attachment.document.name))
+        self.assertFalse(test_storage.exists(self.orphan))
+    
+    def test_keeps_shared_images(self):
+        photo = RecordingPhoto()
+        photo.deduplicated.save('photo.png', image_content((60, 40)))
+        paths = photo.deduplicated.field.get_paths(photo.deduplicated.data)
+        #only the SharedImage entry references the files now
+        RecordingPhoto.objects.filter(pk=photo.pk).update(deduplicated='')
+        age_files(recording_storage)
+        cleanup('photoprocessor.recordingphoto')
+        self.assertTrue(paths)
+        for path in paths:
+            self.assertTrue(recording_storage.exists(path))
+    
+    def test_no_static_directory(self):
+        for upload_to in ('', '.', './', '%Y/%m'):
+            field = ImageWithProcessorsField(upload_to=upload_to, thumbnails={})
+            self.assertEqual(field.get_static_directory(), None)
+        field = ImageWithProcessorsField(upload_to='photos/%Y', thumbnails={})
+        self.assertEqual(field.get_static_directory(), 'photos')
+
+class BackfillPlaceholdersTestCase(TestCase):
+    def setUp(self):
+        self.photo = Photo()
+        self.photo.placeholder.save('photo.png', image_content((60, 40)))
+        #a row saved before the field had placeholder=True
+        info = self.photo.placeholder.image_data['info']
+        del info['placeholder'], info['color']
+        self.photo.save()
+    
+    def test_backfills_missing_placeholders(self):
+        capture(ReprocessCommand().backfill_placeholders, Photo, ['placeholder'])
+        info = Photo.objects.get(pk=self.photo.pk).placeholder.image_data['info']
+        self.assertTrue(info['placeholder'].startswith('data:image/jpeg;base64,'))
+        self.assertTrue(info['color'].startswith('#'))
+        self.assertEqual(info['format'], 'PNG')
+        self.assertEqual(info['size'], {'width':60, 'height':40})
+    
+    def test_isolated(self):
+        field = Photo._meta.get_field('placeholder')
+        field.isolated = True
+        try:
+            capture(ReprocessCommand().backfill_placeholders, Photo, ['placeholder'])
+        finally:
+            field.isolated = None
+        info = Photo.objects.get(pk=self.photo.pk).placeholder.image_data['info']
+        self.assertTrue(info['placeholder'].startswith('data:image/jpeg;base64,'))
+    
+    def test_admission_budget(self):
+        from photoprocessor import admission, settings
+        from photoprocessor.admission import Budget
+        budget, admission_setting = admission._budget, settings.ADMISSION
+        admission._budget, settings.ADMISSION = Budget(max_pixels=100), {'max_pixels':100}
+        try:
+            output = capture(ReprocessCommand().backfill_placeholders, Photo, ['placeholder'])
+        finally:
+            admission._budget, settings.ADMISSION = budget, admission_setting
+        self.assertTrue('1 placeholders deferred' in output)
+        info = Photo.objects.get(pk=self.photo.pk).placeholder.image_data['info']
+        self.assertFalse('placeholder' in info)
+    
+    def test_leaves_filled_rows_alone(self):
+        photo = Photo.objects.get(pk=self.photo.pk)
+        photo.placeholder.image_data['info']['placeholder'] = 'data:existing'
+        photo.save()
+        capture(ReprocessCommand().backfill_placeholders, Photo, ['placeholder'])
+        info = Photo.objects.get(pk=self.photo.pk).placeholder.image_data['info']
+        self.assertEqual(info['placeholder'], 'data:existing')
+        capture(ReprocessCommand().backfill_placeholders, Photo, ['placeholder'], force=True)
+        info = Photo.objects.get(pk=self.photo.pk).placeholder.image_data['info']
+        self.assertTrue(info['placeholder'].startswith('data:image/jpeg;base64,'))
+
+class PlanTestCase(TestCase):
+    def setUp(self):
+        self.current = Photo()
+        self.current.image.save('current.png', image_content((1000, 1000)))
+        self.stale = Photo()
+        self.stale.image.save('stale.png', image_content((1000, 1000)))
+        self.stale.image.data['thumb']['fingerprint'] = 'outdated'
+        self.stale.save()
+        self.proxied = RecordingPhoto()
+        self.proxied.proxied.save('proxied.png', image_content((1000, 800)))
+        self.proxied.proxied.data['thumb']['fingerprint'] = 'outdated'
+        self.proxied.save()
+    
+    def stored_files(self):
+        found = set()
+        for root, dirs, files in os.walk(test_storage.location):
+            found.update([os.path.join(root, name) for name in files])
+        return found
+    
+    def test_plan(self):
+        stored = self.stored_files()
+        recording_storage.calls = list()
+        output = capture(call_command, 'reprocess_photos', 'photoprocessor.photo', 'photoprocessor.recordingphoto', plan=True)
+        lines = [line.strip() for line in output.splitlines()]
+        filesize = self.stale.image['thumb'].info['filesize']
+        self.assertTrue('Photo.image: 1 objects to process, 1.0 source megapixels' in lines)
+        self.assertTrue('thumb: 1 current, 1 stale, 0 missing, ~%s to write' % format_bytes(filesize) in lines)
+        self.assertTrue('display: 2 current, 0 stale, 0 missing, ~0.0B to write' in lines)
+        #the stale thumb is rendered from the 30x24 proxy, not the 1000x800 original
+        self.assertTrue('RecordingPhoto.proxied: 1 objects to process, 0.0 source megapixels' in lines)
+        self.assertEqual(self.stored_files(), stored)
+        self.assertEqual(recording_storage.calls, [])
+        self.assertEqual(Photo.objects.get(pk=self.stale.pk).image.data['thumb']['fingerprint'], 'outdated')
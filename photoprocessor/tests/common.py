@@ -1,8 +1,8 @@
-
 class MockImage(object):
     def __init__(self, size, **kwargs):
         self.size = size
         self.kwargs = kwargs
+        self.info = kwargs.get('info', {})
     
     def crop(self, left, top, right, bottom):
         size = min(right-left, self.size[0]), min(bottom-top, self.size[1])
@@ -10,3 +10,60 @@ class MockImage(object):
     
     def resize(self, new_size, resample=None):
         return MockImage(new_size, resize=new_size, source=self)
+
+def image_content(size=(20, 20), format='PNG', name='test.png'):
+    """ Returns a ContentFile holding a freshly encoded solid image """
+    from StringIO import StringIO
+    from django.core.files.base import ContentFile
+    from photoprocessor.lib import Image
+    buf = StringIO()
+    Image.new('RGB', size, (255, 0, 0)).save(buf, format)
+    content = ContentFile(buf.getvalue())
+    content.name = name
+    return content
+
+import tempfile
+
+from django.db import models
+from django.core.files.storage import FileSystemStorage
+
+from photoprocessor.fields import ImageWithProcessorsField
+from photoprocessor.testing import RecordingStorage
+
+THUMBNAILS = {'thumb':{'resize':{'width':10, 'height':10, 'crop':'center'}},
+              'display':{'resize':{'width':50, 'height':50, 'crop':'scale'}},}
+
+test_storage = FileSystemStorage(location=tempfile.mkdtemp(prefix='photoprocessor-tests-'))
+
+recording_storage = RecordingStorage(location=tempfile.mkdtemp(prefix='photoprocessor-tests-'))
+
+def image_field(storage=test_storage, **kwargs):
+    return ImageWithProcessorsField(upload_to='photos', thumbnails=THUMBNAILS, storage=storage, **kwargs)
+
+class Photo(models.Model):
+    """ image is the plain field, the others each turn on one option """
+    image = image_field(serve=True)
+    indexed = image_field(thumbnail_index=True)
+    content_addressed = image_field(content_addressed=True)
+    isolated = image_field(isolated=True)
+    placeholder = image_field(placeholder=True)
+    
+    class Meta:
+        app_label = 'photoprocessor'
+
+class RecordingPhoto(models.Model):
+    """ The same on recording_storage, for the options whose storage calls are tested """
+    image = image_field(recording_storage)
+    siblings = image_field(recording_storage, generate_siblings=True)
+    deduplicated = image_field(recording_storage, deduplicate=True)
+    proxied = image_field(recording_storage, proxy=30)
+    
+    class Meta:
+        app_label = 'photoprocessor'
+
+class Attachment(models.Model):
+    """ A plain file field uploading next to the photos """
+    document = models.FileField(upload_to='photos', storage=test_storage)
+    
+    class Meta:
+        app_label = 'photoprocessor'
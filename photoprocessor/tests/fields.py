@@ -0,0 +1,220 @@
+from StringIO import StringIO
+import hashlib
+import os
+
+from django.utils import unittest
+from django.core.files.base import ContentFile
+from django.test import TestCase
+from django.core.exceptions import ValidationError
+
+from common import image_content, Photo, RecordingPhoto, THUMBNAILS, test_storage, recording_storage
+
+from photoprocessor.fields import ImageWithProcessorsField
+from photoprocessor.lib import Image
+
+class ValidateImageTestCase(unittest.TestCase):
+    def make_field(self, **kwargs):
+        return ImageWithProcessorsField(upload_to='test', thumbnails={}, **kwargs)
+    
+    def test_accepts_within_limits(self):
+        field = self.make_field(max_pixels=400, max_dimensions=(20, 20), allowed_formats=['PNG'])
+        self.assertEqual(field.validate_image(image_content((20, 20))), ('PNG', (20, 20)))
+    
+    def test_rejects_too_many_pixels(self):
+        field = self.make_field(max_pixels=399)
+        self.assertRaises(ValidationError, field.validate_image, image_content((20, 20)))
+    
+    def test_rejects_dimensions(self):
+        field = self.make_field(max_dimensions=(None, 10))
+        self.assertRaises(ValidationError, field.validate_image, image_content((5, 20)))
+    
+    def test_rejects_format(self):
+        field = self.make_field(allowed_formats=['JPEG'])
+        self.assertRaises(ValidationError, field.validate_image, image_content())
+    
+    def test_rejects_garbage(self):
+        from django.core.files.base import ContentFile
+        field = self.make_field()
+        self.assertRaises(ValidationError, field.validate_image, ContentFile('not an image'))
+    
+    def test_restores_position(self):
+        content = image_content()
+        self.make_field().validate_image(content)
+        self.assertEqual(content.tell(), 0)
+
+class WrapperCacheTestCase(unittest.TestCase):
+    def make_data(self):
+        return {'original':{'path':'photos/a.png', 'info':{'size':{'width':20, 'height':20}}},
+                'thumb':{'path':'photos/a-thumb.png', 'info':{'size':{'width':10, 'height':10}}},}
+    
+    def test_field_file_is_reused(self):
+        photo = Photo(image=self.make_data())
+        self.assertTrue(photo.image is photo.image)
+        self.assertTrue(photo.image['thumb'] is photo.image['thumb'])
+    
+    def test_set_invalidates(self):
+        photo = Photo(image=self.make_data())
+        field_file = photo.image
+        thumb = field_file['thumb']
+        photo.image = self.make_data()
+        self.assertFalse(photo.image is field_file)
+        self.assertFalse(photo.image['thumb'] is thumb)
+    
+    def test_changed_data_invalidates_thumbnail(self):
+        photo = Photo(image=self.make_data())
+        thumb = photo.image['thumb']
+        photo.image.data['thumb'] = {'path':'photos/b-thumb.png', 'info':{}}
+        self.assertEqual(photo.image['thumb'].name, 'photos/b-thumb.png')
+        self.assertFalse(photo.image['thumb'] is thumb)
+
+class GetPathsTestCase(unittest.TestCase):
+    def test_paths(self):
+        field = Photo._meta.get_field('image')
+        data = {'original':{'path':'photos/a.png'}, 'thumb':{'path':'photos/a-thumb.png'}}
+        self.assertEqual(sorted(field.get_paths(data)), ['photos/a-thumb.png', 'photos/a.png'])
+        self.assertEqual(sorted(field.get_paths(field.dumps(data))), ['photos/a-thumb.png', 'photos/a.png'])
+        self.assertEqual(field.get_paths('photos/old.png'), ['photos/old.png'])
+        self.assertEqual(field.get_paths(''), [])
+
+class ContentAddressedTestCase(TestCase):
+    def test_same_content_same_names(self):
+        first = Photo()
+        first.content_addressed.save('first.png', image_content((60, 40)))
+        second = Photo()
+        second.content_addressed.save('second.png', image_content((60, 40)))
+        self.assertEqual(first.content_addressed.data['original']['digest'], second.content_addressed.data['original']['digest'])
+        for key in THUMBNAILS:
+            self.assertEqual(first.content_addressed[key].name, second.content_addressed[key].name)
+            self.assertEqual(first.content_addressed[key].width(), second.content_addressed[key].width())
+    
+    def test_hashes_while_reading(self):
+        frombytes = getattr(Image, 'frombytes', None) or Image.fromstring
+        buf = StringIO()
+        frombytes('RGB', (200, 200), os.urandom(200 * 200 * 3)).save(buf, 'PNG')
+        data = buf.getvalue()
+        read = list()
+        class CountingIO(StringIO):
+            def read(self, *args):
+                chunk = StringIO.read(self, *args)
+                read.append(len(chunk))
+                return chunk
+        content = ContentFile(data)
+        content.file = CountingIO(data)
+        photo = Photo()
+        photo.content_addressed.save('photo.png', content)
+        self.assertEqual(photo.content_addressed.data['original']['digest'], hashlib.sha1(data).hexdigest())
+        #one pass to hash and decode, one for the storage, not a third for the digest
+        self.assertTrue(sum(read) < 2.5 * len(data))
+    
+    def test_delete_keeps_shared_thumbnails(self):
+        photo = Photo()
+        photo.content_addressed.save('photo.png', image_content((60, 40)))
+        thumb_name = photo.content_addressed['thumb'].name
+        photo.content_addressed.delete()
+        self.assertTrue(test_storage.exists(thumb_name))
+
+class SaveTestCase(TestCase):
+    def test_processes_from_content(self):
+        recording_storage.calls = list()
+        photo = RecordingPhoto()
+        photo.image.save('photo.png', image_content((60, 40)))
+        self.assertFalse([call for call in recording_storage.calls if call[0] == 'open'])
+        self.assertTrue(recording_storage.exists(photo.image.name))
+        self.assertEqual(photo.image.data['original']['info']['size'], {'width':60, 'height':40})
+        self.assertEqual(photo.image['display'].width(), 50)
+
+class AsyncTestCase(unittest.TestCase):
+    #save=False throughout, worker threads do not share the test database
+    def test_asave(self):
+        photo = Photo()
+        result = photo.image.asave('photo.png', image_content((60, 40)), save=False)
+        self.assertEqual(result.get(timeout=30), None)
+        self.assertEqual(photo.image['thumb'].width(), 10)
+        self.assertTrue(test_storage.exists(photo.image.name))
+    
+    def test_aget_unknown_key(self):
+        self.assertRaises(KeyError, Photo().image.aget, 'missing')
+
+class GenerateSiblingsTestCase(TestCase):
+    def test_one_decode_for_all_missing(self):
+        photo = RecordingPhoto()
+        photo.siblings.save('photo.png', image_content((60, 40)))
+        photo = RecordingPhoto.objects.get(pk=photo.pk)
+        for key in THUMBNAILS:
+            del photo.siblings.data[key]
+        recording_storage.calls = list()
+        self.assertEqual(photo.siblings['thumb'].width(), 10)
+        self.assertTrue('display' in photo.siblings.data)
+        self.assertEqual(len([call for call in recording_storage.calls if call[0] == 'open']), 1)
+
+
+class ProxyTestCase(TestCase):
+    def setUp(self):
+        self.photo = RecordingPhoto()
+        self.photo.proxied.save('photo.png', image_content((120, 80)))
+    
+    def test_stored_downscaled(self):
+        proxy = self.photo.proxied.data['proxy']
+        self.assertEqual(proxy['info']['size'], {'width':30, 'height':20})
+        self.assertTrue(recording_storage.exists(proxy['path']))
+    
+    def opened(self):
+        return [call[1] for call in recording_storage.calls if call[0] == 'open']
+    
+    def test_small_specs_use_proxy(self):
+        photo = RecordingPhoto.objects.get(pk=self.photo.pk)
+        for key in THUMBNAILS:
+            del photo.proxied.data[key]
+        recording_storage.calls = list()
+        photo.proxied.generate_thumbnails(['thumb'])
+        self.assertEqual(self.opened(), [photo.proxied.data['proxy']['path']])
+        self.assertEqual(photo.proxied['thumb'].width(), 10)
+        
+        recording_storage.calls = list()
+        photo.proxied.generate_thumbnails(['display'])
+        self.assertEqual(self.opened(), [photo.proxied.name])
+        self.assertEqual(photo.proxied['display'].width(), 50)
+    
+    def test_reprocess_reads_only_the_proxy(self):
+        field = RecordingPhoto._meta.get_field('proxied')
+        thumbnails = field.thumbnails
+        field.thumbnails = dict(thumbnails, thumb={'resize':{'width':12, 'height':12, 'crop':'center'}})
+        try:
+            photo = RecordingPhoto.objects.get(pk=self.photo.pk)
+            recording_storage.calls = list()
+            photo.proxied.reprocess()
+        finally:
+            field.thumbnails = thumbnails
+        self.assertEqual(self.opened(), [photo.proxied.data['proxy']['path']])
+        self.assertEqual(photo.proxied['thumb'].width(), 12)
+        self.assertEqual(photo.proxied.data['original']['info']['size'], {'width':120, 'height':80})
+    
+    def test_isolated_upload_renders_from_upload(self):
+        field = RecordingPhoto._meta.get_field('proxied')
+        field.isolated = True
+        try:
+            recording_storage.calls = list()
+            photo = RecordingPhoto()
+            photo.proxied.save('photo.png', image_content((120, 80)))
+        finally:
+            field.isolated = None
+        self.assertTrue('proxy' in photo.proxied.data)
+        self.assertEqual(self.opened(), [])
+        self.assertEqual(photo.proxied['display'].width(), 50)
+    
+    def test_delete_removes_proxy(self):
+        path = self.photo.proxied.data['proxy']['path']
+        self.photo.proxied.delete()
+        self.assertFalse(recording_storage.exists(path))
+    
+    def test_no_proxy_for_small_original(self):
+        path = self.photo.proxied.data['proxy']['path']
+        self.photo.proxied.save('small.png', image_content((30, 20)))
+        self.assertFalse('proxy' in self.photo.proxied.data)
+        self.assertFalse(self.photo.proxied.proxy_satisfies(self.photo.proxied.field.get_pipeline('thumb')))
+        #an older proxy of a small original is dropped on reprocess
+        self.photo.proxied.data['proxy'] = {'path':path, 'info':{'size':{'width':30, 'height':20}},
+                                          'fingerprint':self.photo.proxied.field.get_proxy_pipeline().fingerprint}
+        self.photo.proxied.reprocess()
+        self.assertFalse('proxy' in self.photo.proxied.data)
+        self.assertFalse(recording_storage.exists(path))
@@ -0,0 +1,24 @@
+import time
+
+from django.utils import unittest
+
+from common import image_content, Photo
+
+from photoprocessor.isolation import IsolatedPool, ProcessingError
+
+class IsolationTestCase(unittest.TestCase):
+    def test_save_in_child_processes(self):
+        photo = Photo()
+        photo.isolated.save('photo.png', image_content((60, 40)), save=False)
+        self.assertEqual(photo.isolated.data['original']['info']['size'], {'width':60, 'height':40})
+        self.assertEqual(photo.isolated['thumb'].width(), 10)
+        self.assertTrue(photo.isolated['display'].info['filesize'] > 0)
+    
+    def test_timeout(self):
+        pool = IsolatedPool(processes=1, timeout=0.5)
+        try:
+            self.assertRaises(ProcessingError, pool.run, time.sleep, 5)
+            #a fresh pool replaces the one that timed out
+            self.assertEqual(pool.run(abs, -1), 1)
+        finally:
+            pool.terminate()
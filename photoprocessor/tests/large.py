@@ -0,0 +1,85 @@
+from django.utils import unittest
+from django.test import TestCase
+
+from StringIO import StringIO
+
+from photoprocessor import large
+from photoprocessor.lib import Image
+from photoprocessor.processors import Pipeline
+
+from common import image_content, Photo
+
+class RequiredScaleTestCase(unittest.TestCase):
+    def test_downscale(self):
+        pipeline = Pipeline({'resize':{'width':100, 'height':100, 'crop':'center'}})
+        self.assertEqual(pipeline.required_scale((1000, 500)), 0.2)
+    
+    def test_upscale(self):
+        pipeline = Pipeline({'resize':{'width':100, 'height':100, 'upscale':True}})
+        self.assertEqual(pipeline.required_scale((50, 50)), None)
+    
+    def test_needs_full_source(self):
+        pipeline = Pipeline({'autocrop':True, 'resize':{'width':100, 'height':100}})
+        self.assertEqual(pipeline.required_scale((1000, 1000)), None)
+        self.assertEqual(Pipeline({'quality':80}).required_scale((1000, 1000)), None)
+
+class BandTestCase(unittest.TestCase):
+    def test_split_raw(self):
+        tile = ('raw', (0, 0, 10, 100), 54, ('BGR', 32, -1))
+        strips = large.split_raw(tile, 40)
+        self.assertEqual([strip[1] for strip in strips],
+                         [(0, 0, 10, 40), (0, 40, 10, 80), (0, 80, 10, 100)])
+        self.assertEqual([strip[2] for strip in strips], [54 + 60 * 32, 54 + 20 * 32, 54])
+    
+    def test_bands(self):
+        tiles = [('zip', (x, y, x + 10, y + 10), 0, 'RGB') for y in range(0, 50, 10) for x in (0, 10)]
+        result = list(large.bands(tiles, 20))
+        self.assertEqual([(top, bottom) for top, bottom, band in result], [(0, 20), (20, 40), (40, 50)])
+        self.assertEqual(len(result[0][2]), 4)
+    
+    def encoded(self, format, size=(400, 300)):
+        buf = StringIO()
+        Image.new('RGB', size, (0, 128, 255)).save(buf, format)
+        buf.seek(0)
+        return Image.open(buf)
+    
+    def test_prepare_raw_source(self):
+        pipeline = Pipeline({'resize':{'width':40, 'height':40, 'crop':'center'}})
+        source = self.encoded('BMP', (400, 200))
+        img = large.prepare_source(source, pipeline, threshold=1)
+        self.assertEqual(img.size, (80, 40))
+        self.assertEqual(img.getpixel((40, 20)), (0, 128, 255))
+        self.assertTrue(source.tile) #the shared source was left undecoded
+    
+    def test_prepare_jpeg_source(self):
+        pipeline = Pipeline({'resize':{'width':40, 'height':40, 'crop':'scale'}})
+        img, info = pipeline.process(self.encoded('JPEG'))
+        self.assertEqual(img.size, (40, 30))
+        img = large.prepare_source(self.encoded('JPEG'), pipeline, threshold=1)
+        self.assertEqual(img.size, (40, 30))
+
+class LargeSaveTestCase(TestCase):
+    def setUp(self):
+        self.threshold = large.LARGE_IMAGE_PIXELS
+        self.decode_reduced = large.decode_reduced
+        large.LARGE_IMAGE_PIXELS = 1
+        self.decoded = list()
+        def decode_reduced(image, size):
+            self.decoded.append(size)
+            return self.decode_reduced(image, size)
+        large.decode_reduced = decode_reduced
+    
+    def tearDown(self):
+        large.LARGE_IMAGE_PIXELS = self.threshold
+        large.decode_reduced = self.decode_reduced
+    
+    def test_save_decodes_reduced(self):
+        photo = Photo()
+        photo.placeholder.save('photo.jpg', image_content((400, 300), 'JPEG', 'photo.jpg'))
+        #the placeholder, then each spec, all from the undecoded upload
+        self.assertEqual(sorted(self.decoded), [(14, 10), (16, 12), (50, 38)])
+        info = photo.placeholder.data['original']['info']
+        self.assertEqual(info['size'], {'width':400, 'height':300})
+        self.assertEqual(info['format'], 'JPEG')
+        self.assertTrue(info['placeholder'].startswith('data:image/jpeg;base64,'))
+        self.assertEqual(photo.placeholder['display'].width(), 50)
@@ -0,0 +1,75 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+from django.test import TestCase
+
+from common import image_content, Photo, RecordingPhoto, THUMBNAILS, recording_storage
+
+from photoprocessor.fields import ImageWithProcessorsField
+from photoprocessor.models import ThumbnailIndex, SharedImage
+
+class ThumbnailIndexTestCase(TestCase):
+    def setUp(self):
+        self.photo = Photo()
+        self.photo.indexed.save('photo.png', image_content((60, 40)))
+        self.field = Photo._meta.get_field('indexed')
+        self.thumbnails = self.field.thumbnails
+    
+    def tearDown(self):
+        self.field.thumbnails = self.thumbnails
+    
+    def test_rows_follow_data(self):
+        rows = ThumbnailIndex.objects.for_field(Photo, 'indexed')
+        self.assertEqual(rows.count(), 2)
+        thumb = rows.get(key='thumb')
+        self.assertEqual((thumb.width, thumb.height), (10, 10))
+        self.assertTrue(thumb.filesize > 0)
+        self.assertEqual(thumb.path, self.photo.indexed['thumb'].name)
+        self.photo.delete()
+        self.assertEqual(rows.count(), 0)
+    
+    def test_stale_and_missing(self):
+        self.assertEqual(ThumbnailIndex.objects.stale(Photo, 'indexed').count(), 0)
+        self.field.thumbnails = dict(self.field.thumbnails)
+        self.field.thumbnails['thumb'] = {'resize':{'width':20, 'height':20, 'crop':'center'}}
+        stale = ThumbnailIndex.objects.stale(Photo, 'indexed')
+        self.assertEqual([row.key for row in stale], ['thumb'])
+        self.assertEqual(ThumbnailIndex.objects.missing(Photo, 'indexed', 'thumb').count(), 0)
+    
+    def test_rejects_non_integer_pk(self):
+        def define():
+            class SluggedPhoto(models.Model):
+                image = ImageWithProcessorsField(upload_to='photos', thumbnails=THUMBNAILS, thumbnail_index=True)
+                slug = models.SlugField(primary_key=True)
+                
+                class Meta:
+                    app_label = 'photoprocessor'
+        self.assertRaises(ImproperlyConfigured, define)
+
+
+class SharedImageTestCase(TestCase):
+    def upload(self):
+        photo = RecordingPhoto()
+        photo.deduplicated.save('photo.png', image_content((60, 40)))
+        return photo
+    
+    def test_reuses_identical_upload(self):
+        first = self.upload()
+        recording_storage.calls = list()
+        second = self.upload()
+        self.assertFalse([call for call in recording_storage.calls if call[0] in ('open', 'save')])
+        self.assertEqual(first.deduplicated.name, second.deduplicated.name)
+        for key in THUMBNAILS:
+            self.assertEqual(first.deduplicated[key].name, second.deduplicated[key].name)
+        self.assertEqual(SharedImage.objects.get().refcount, 2)
+    
+    def test_delete_keeps_files_until_last_reference(self):
+        first = self.upload()
+        second = self.upload()
+        paths = [first.deduplicated.name] + [first.deduplicated[key].name for key in THUMBNAILS]
+        first.deduplicated.delete()
+        for path in paths:
+            self.assertTrue(recording_storage.exists(path))
+        second.deduplicated.delete()
+        for path in paths:
+            self.assertFalse(recording_storage.exists(path))
+        self.assertEqual(SharedImage.objects.count(), 0)
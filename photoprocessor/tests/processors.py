@@ -16,3 +16,103 @@ class ResizeTestCase(unittest.TestCase):
         new_image = self.processor.process(img, config, info)
         self.assertEqual(new_image.size, (25,50))
 
+
+class PipelineTestCase(unittest.TestCase):
+    def test_only_applicable_processors(self):
+        pipeline = processors.Pipeline({'resize':{'width':50, 'height':50}})
+        classes = [type(proc) for proc in pipeline.processors]
+        self.assertTrue(processors.Resize in classes)
+        self.assertFalse(processors.Reflection in classes)
+        self.assertFalse(processors.Quality in classes)
+    
+    def test_validation_error(self):
+        from django.core.exceptions import ImproperlyConfigured
+        self.assertRaises(ImproperlyConfigured, processors.Pipeline, {'resize':{'height':50}})
+    
+    def test_fingerprint(self):
+        config = {'resize':{'width':50, 'height':50}, 'quality':90}
+        pipeline = processors.Pipeline(config)
+        self.assertEqual(pipeline.fingerprint, processors.Pipeline(dict(config)).fingerprint)
+        config['quality'] = 80
+        self.assertNotEqual(pipeline.fingerprint, processors.Pipeline(config).fingerprint)
+    
+    def test_predict_size(self):
+        pipeline = processors.Pipeline({'resize':{'width':50, 'height':50, 'crop':'scale'}})
+        self.assertEqual(pipeline.predict_size((200, 100)), (50, 25))
+        pipeline = processors.Pipeline({'resize':{'width':50, 'height':50, 'crop':'center'}})
+        self.assertEqual(pipeline.predict_size((200, 100)), (50, 50))
+        self.assertEqual(pipeline.predict_size((20, 10)), (20, 10))
+    
+    def test_immutable(self):
+        pipeline = processors.Pipeline({'quality':90})
+        self.assertRaises(AttributeError, setattr, pipeline, '_config', {})
+        pipeline.config['quality'] = 10
+        self.assertTrue(pipeline.matches({'quality':90}))
+
+class MetadataTestCase(unittest.TestCase):
+    def make_image(self):
+        return MockImage((100, 100), info={'icc_profile':'\x00\x01binary', 'exif':'Exif\x00\x00',
+                                           'dpi':(72, 72), 'jfif':257})
+    
+    def test_strip(self):
+        img = self.make_image()
+        info = {}
+        img = processors.Metadata().process(img, {'metadata':{'profile':'strip'}}, info)
+        self.assertEqual(sorted(img.info.keys()), ['dpi', 'jfif'])
+        self.assertEqual(info['profile'], 'strip')
+    
+    def test_keep(self):
+        img = processors.Metadata().process(self.make_image(), {'metadata':{'profile':'keep'}}, {})
+        self.assertTrue('icc_profile' in img.info)
+    
+    def test_extra_info_is_compact(self):
+        info = {}
+        processors.ExtraInfo().process(self.make_image(), {}, info)
+        self.assertEqual(info['extra_info'], {'dpi':[72, 72], 'jfif':257})
+    
+    def test_exif_only_in_info_spec(self):
+        from photoprocessor.fields import ImageWithProcessorsField
+        field = ImageWithProcessorsField(upload_to='test', thumbnails={'thumb':{'quality':80}},
+                                         metadata={'exif':['Make']})
+        self.assertEqual(field.get_info_spec()['exif'], ['Make'])
+        self.assertFalse(processors.ExifInfo().applies(field.get_spec('thumb')))
+    
+    def test_compact_value(self):
+        from photoprocessor.utils import compact_value
+        self.assertEqual(compact_value((1, 4), rational=True), 0.25)
+        self.assertEqual(compact_value((0, 1), rational=True), 0.0)
+        self.assertEqual(compact_value(((51, 1), (0, 1), (3000, 100)), rational=True), [51.0, 0.0, 30.0])
+        self.assertEqual(compact_value((72, 72)), [72, 72])
+        self.assertEqual(compact_value('Canon\x00'), u'Canon')
+        self.assertEqual(compact_value('\xff\xd8\xff'), None)
+
+class PlaceholderTestCase(unittest.TestCase):
+    def test_preview_and_color(self):
+        from photoprocessor.lib import Image
+        info = processors.process_image_info(Image.new('RGB', (200, 100), (255, 0, 0)), {'placeholder':True})
+        self.assertEqual(info['color'], '#ff0000')
+        self.assertTrue(info['placeholder'].startswith('data:image/jpeg;base64,'))
+        self.assertTrue(len(info['placeholder']) < 1024)
+    
+    def test_not_configured(self):
+        from photoprocessor.lib import Image
+        info = processors.process_image_info(Image.new('RGB', (200, 100), (255, 0, 0)), {})
+        self.assertFalse('placeholder' in info)
+
+class FocalPointTestCase(unittest.TestCase):
+    def make_image(self):
+        from photoprocessor.lib import Image
+        img = Image.new('L', (200, 100), 0)
+        img.paste(255, (150, 40, 190, 60))
+        return img
+    
+    def test_found_on_original(self):
+        info = processors.process_image_info(self.make_image(), {'focal_point':True})
+        self.assertTrue(info['focal_point']['x'] > 0.5)
+    
+    def test_smart_crop_centres_on_seed(self):
+        pipeline = processors.Pipeline({'resize':{'width':50, 'height':50, 'crop':'smart'}})
+        img, info = pipeline.process(self.make_image(), {'focal_point':{'x':0.9, 'y':0.5}})
+        self.assertEqual(img.size, (50, 50))
+        self.assertEqual(img.getpixel((35, 25)), 255)
+        self.assertFalse('focal_point' in info)
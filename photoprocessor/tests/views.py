@@ -0,0 +1,47 @@
+from django.http import Http404
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from common import image_content, Photo, RecordingPhoto
+
+from photoprocessor.views import thumbnail
+
+class ThumbnailViewTestCase(TestCase):
+    def setUp(self):
+        self.photo = Photo()
+        self.photo.image.save('photo.png', image_content((60, 40)))
+        del self.photo.image.data['display']
+        self.photo.save()
+    
+    def test_generates_then_not_modified(self):
+        url = self.photo.image.lazy_url('display')
+        self.assertTrue(url.startswith('/photos/photoprocessor/photo/'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['ETag'])
+        self.assertTrue('private' in response['Cache-Control'])
+        self.assertTrue('max-age=60' in response['Cache-Control'])
+        photo = Photo.objects.get(pk=self.photo.pk)
+        self.assertEqual(photo.image['display'].width(), 50)
+        self.assertTrue(response['Location'].endswith(photo.image['display'].url))
+        
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(photo.image.lazy_url('display'), photo.image['display'].url)
+    
+    def test_unsigned_url(self):
+        url = self.photo.image.lazy_url('display').split('?')[0]
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url + '?sig=0').status_code, 403)
+        self.assertFalse('display' in Photo.objects.get(pk=self.photo.pk).image.data)
+    
+    def test_field_not_served(self):
+        photo = RecordingPhoto()
+        photo.image.save('photo.png', image_content((60, 40)))
+        #called directly, the test settings have no 404.html to render
+        request = RequestFactory().get('/')
+        self.assertRaises(Http404, thumbnail, request, 'photoprocessor', 'recordingphoto', photo.pk, 'image', 'display')
+    
+    def test_unknown_key(self):
+        request = RequestFactory().get('/')
+        self.assertRaises(Http404, thumbnail, request, 'photoprocessor', 'photo', self.photo.pk, 'image', 'missing')
@@ -0,0 +1,100 @@
+import os
+import sys
+import tempfile
+import threading
+
+from django.test import TestCase
+from django.utils import unittest
+
+from common import image_content, THUMBNAILS, Photo
+
+from photoprocessor.fields import ImageWithProcessorsFieldFile
+from photoprocessor.testing import RecordingStorage
+from photoprocessor.utils import map_in_threads, get_thread_pool, ThreadExecutor
+
+class WriteBehindTestCase(TestCase):
+    def make_photo(self, **kwargs):
+        self.storage = RecordingStorage(location=tempfile.mkdtemp(prefix='photoprocessor-tests-'), **kwargs)
+        field = Photo._meta.get_field('image')
+        self.old = field.storage, field.write_behind
+        field.storage, field.write_behind = self.storage, 4
+        return Photo()
+    
+    def tearDown(self):
+        field = Photo._meta.get_field('image')
+        field.storage, field.write_behind = self.old
+    
+    def stored_files(self):
+        found = list()
+        for root, dirs, files in os.walk(self.storage.location):
+            found.extend(files)
+        return found
+    
+    def test_uploads_overlap(self):
+        photo = self.make_photo(latency=0.2)
+        photo.image.save('photo.png', image_content((60, 40)))
+        #the original and both thumbnails were being stored at the same time
+        self.assertTrue(self.storage.max_in_flight > 1)
+        for key in THUMBNAILS:
+            self.assertTrue(self.storage.exists(photo.image[key].name))
+    
+    def test_failure_leaves_nothing_behind(self):
+        photo = self.make_photo(latency=0.05, fail_on='display')
+        self.assertRaises(IOError, photo.image.save, 'photo.png', image_content((60, 40)), False)
+        self.assertEqual(self.stored_files(), [])
+        self.assertFalse('thumb' in photo.image.data)
+    
+    def test_failed_original_upload_removes_thumbnails(self):
+        photo = self.make_photo(latency=0.05, fail_on='photo.png')
+        self.assertRaises(IOError, photo.image.save, 'photo.png', image_content((60, 40)), False)
+        self.assertEqual(self.stored_files(), [])
+        self.assertEqual(photo.image.data, {})
+    
+    def test_processing_error_removes_queued_uploads(self):
+        photo = self.make_photo(latency=0.1)
+        process_thumbnail = ImageWithProcessorsFieldFile._process_thumbnail
+        calls = list()
+        def failing(field_file, *args, **kwargs):
+            calls.append(args)
+            if len(calls) > 1:
+                raise IOError('encoder failed')
+            return process_thumbnail(field_file, *args, **kwargs)
+        ImageWithProcessorsFieldFile._process_thumbnail = failing
+        try:
+            self.assertRaises(IOError, photo.image.save, 'photo.png', image_content((60, 40)), False)
+        finally:
+            ImageWithProcessorsFieldFile._process_thumbnail = process_thumbnail
+        self.assertEqual(self.stored_files(), [])
+
+
+class WithoutMultiprocessingTestCase(unittest.TestCase):
+    """ Python 2.5 has no multiprocessing, threads are used directly """
+    def setUp(self):
+        self.module = sys.modules.get('multiprocessing.pool')
+        sys.modules['multiprocessing.pool'] = None #makes the import fail
+    
+    def tearDown(self):
+        if self.module is None:
+            del sys.modules['multiprocessing.pool']
+        else:
+            sys.modules['multiprocessing.pool'] = self.module
+    
+    def test_thread_executor(self):
+        pool = get_thread_pool(2)
+        self.assertTrue(isinstance(pool, ThreadExecutor))
+        self.assertEqual(pool.apply_async(max, (1, 2)).get(timeout=5), 2)
+    
+    def test_map_in_threads(self):
+        threads = set()
+        def record(item):
+            threads.add(threading.currentThread())
+            return item * 2
+        self.assertEqual(map_in_threads(record, range(4), 2), [0, 2, 4, 6])
+        self.assertFalse(threading.currentThread() in threads)
+    
+    def test_map_in_threads_reraises(self):
+        def fail(item):
+            if item == 2:
+                raise IOError('delete failed')
+            return item
+        self.assertRaises(IOError, map_in_threads, fail, range(4), 2)
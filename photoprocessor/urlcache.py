@@ -0,0 +1,93 @@
+"""
+Caches the results of storage.url() in Django's cache framework, for
+storages where resolving a url means signing it or another lookup. Keyed
+by storage and path and enabled with PHOTO_URL_CACHE_TIMEOUT; keep the
+timeout below the lifetime of the signed urls. Entries carry the time they
+expire at, so that a url remembered by a field file expires along with the
+cache entry it came from.
+"""
+import hashlib
+import time
+
+from django.utils.encoding import smart_str
+
+from settings import URL_CACHE_TIMEOUT, URL_CACHE_ALIAS
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        from django.core.cache import get_cache as get_django_cache
+        _cache = get_django_cache(URL_CACHE_ALIAS)
+    return _cache
+
+#attributes that tell apart storages of the same class (FileSystemStorage, S3 backends)
+STORAGE_IDENTITY = ('bucket_name', 'location', 'base_url', 'custom_domain')
+
+def storage_identity(storage):
+    """
+    A string naming storage, storage.url_cache_namespace when it is set,
+    otherwise its class and the attributes that make up its urls.
+    """
+    namespace = getattr(storage, 'url_cache_namespace', None)
+    if namespace:
+        return namespace
+    parts = ['%s.%s' % (type(storage).__module__, type(storage).__name__)]
+    for name in STORAGE_IDENTITY:
+        parts.append(smart_str(getattr(storage, name, None) or ''))
+    return '|'.join(parts)
+
+def cache_key(storage, path):
+    identity = storage_identity(storage)
+    return 'photoprocessor:url:%s' % hashlib.sha1('%s:%s' % (identity, smart_str(path))).hexdigest()
+
+def is_current(entry):
+    """ Whether a (url, expires) entry may still be served """
+    return entry is not None and entry[1] is not None and entry[1] > time.time()
+
+def get_entry(storage, path):
+    """
+    Returns (url, expires), expires being the time the url leaves the cache
+    or None when urls are not cached.
+    """
+    if not URL_CACHE_TIMEOUT:
+        return (storage.url(path), None)
+    key = cache_key(storage, path)
+    entry = get_cache().get(key)
+    if not isinstance(entry, tuple):
+        entry = (storage.url(path), time.time() + URL_CACHE_TIMEOUT)
+        get_cache().set(key, entry, URL_CACHE_TIMEOUT)
+    return entry
+
+def get_entries(storage, paths):
+    """ Returns {path: (url, expires)} for paths with a single cache round trip """
+    if not URL_CACHE_TIMEOUT:
+        return dict([(path, (storage.url(path), None)) for path in paths])
+    keys = dict([(cache_key(storage, path), path) for path in paths])
+    entries = dict()
+    for key, entry in get_cache().get_many(keys.keys()).iteritems():
+        if isinstance(entry, tuple):
+            entries[keys[key]] = entry
+    missing = dict()
+    expires = time.time() + URL_CACHE_TIMEOUT
+    for key, path in keys.iteritems():
+        if path not in entries:
+            entries[path] = missing[key] = (storage.url(path), expires)
+    if missing:
+        get_cache().set_many(missing, URL_CACHE_TIMEOUT)
+    return entries
+
+def get_url(storage, path):
+    return get_entry(storage, path)[0]
+
+def get_urls(storage, paths):
+    """ Returns {path: url} for paths with a single cache round trip """
+    entries = get_entries(storage, paths)
+    return dict([(path, entry[0]) for path, entry in entries.iteritems()])
+
+def invalidate(storage, paths):
+    paths = [path for path in paths if path]
+    if URL_CACHE_TIMEOUT and paths:
+        get_cache().delete_many([cache_key(storage, path) for path in paths])
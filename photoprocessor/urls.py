@@ -0,0 +1,6 @@
+from django.conf.urls.defaults import patterns, url
+
+urlpatterns = patterns('photoprocessor.views',
+    url(r'^(?P<app_label>\w+)/(?P<model_name>\w+)/(?P<pk>[^/]+)/(?P<field_name>\w+)/(?P<key>[^/]+)/$',
+        'thumbnail', name='photoprocessor-thumbnail'),
+)
@@ -2,8 +2,18 @@
 
 import tempfile
 import math
+import hashlib
+import sys
+import threading
+from cStringIO import StringIO
 
-from lib import Image
+from lib import Image, ExifTags, JpegImagePlugin
+
+try:
+    from multiprocessing import TimeoutError
+except ImportError: #Python 2.5
+    class TimeoutError(Exception):
+        pass
 
 
 def img_to_fobj(img, info, **kwargs):
@@ -17,10 +27,289 @@ def img_to_fobj(img, info, **kwargs):
     
     if 'quality' in info:
         kwargs['quality'] = info['quality']
+    if info.get('profile') == 'keep':
+        # Encoders only embed these when asked to.
+        for name in ('icc_profile', 'exif'):
+            if name in img.info:
+                kwargs.setdefault(name, img.info[name])
     img.save(tmp, info['format'], **kwargs)
     tmp.seek(0)
     return tmp
 
+def get_exif(img):
+    """
+Return the EXIF tags of an image as a dictionary of tag name to raw value.
+Works on copies too, which lose the _getexif method of JPEG images.
+
+"""
+    if 'exif' not in img.info:
+        return {}
+    try:
+        exif = JpegImagePlugin._getexif(img) or {}
+    except Exception:
+        return {}
+    tags = dict()
+    for tag, value in exif.items():
+        tags[ExifTags.TAGS.get(tag, tag)] = value
+    return tags
+
+#EXIF tags whose values are rationals, stored by PIL as (numerator, denominator)
+RATIONAL_TAGS = set(['XResolution', 'YResolution', 'ExposureTime', 'FNumber', 'CompressedBitsPerPixel',
+                     'ShutterSpeedValue', 'ApertureValue', 'BrightnessValue', 'ExposureBiasValue',
+                     'MaxApertureValue', 'SubjectDistance', 'FocalLength', 'FocalPlaneXResolution',
+                     'FocalPlaneYResolution', 'ExposureIndex', 'DigitalZoomRatio', 'Gamma',
+                     'LensSpecification', 'GPSLatitude', 'GPSLongitude', 'GPSAltitude', 'GPSTimeStamp',
+                     'GPSDOP', 'GPSSpeed', 'GPSTrack', 'GPSImgDirection', 'GPSDestLatitude',
+                     'GPSDestLongitude', 'GPSDestBearing', 'GPSDestDistance'])
+
+def compact_value(value, rational=False):
+    """
+Convert a raw EXIF or image info value into a small JSON friendly value,
+or None if it is binary or otherwise not worth storing. With rational,
+(numerator, denominator) pairs are converted to floats.
+
+"""
+    if isinstance(value, (int, long, float)):
+        return value
+    if hasattr(value, 'numerator') and hasattr(value, 'denominator'):
+        if value.denominator:
+            return float(value.numerator) / value.denominator
+        return None
+    if rational and isinstance(value, tuple) and len(value) == 2 and \
+            isinstance(value[0], (int, long)) and isinstance(value[1], (int, long)):
+        if value[1]:
+            return float(value[0]) / value[1]
+        return None
+    if isinstance(value, (tuple, list)):
+        values = [compact_value(item, rational) for item in value]
+        if None in values:
+            return None
+        return values
+    if isinstance(value, str):
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    if isinstance(value, unicode):
+        value = value.strip(u'\x00 ')
+        if len(value) > 256 or [c for c in value if c < u' ' and c not in u'\t\n\r']:
+            return None
+        return value
+    return None
+
+def thumbnail_signature(app_label, model_name, pk, field_name, key):
+    """
+Sign the address of a thumbnail served by the thumbnail view, so that only
+urls handed out by lazy_url are answered.
+
+"""
+    from django.utils.crypto import salted_hmac
+    value = '/'.join([app_label, model_name, unicode(pk), field_name, key])
+    return salted_hmac('photoprocessor.thumbnail', value.encode('utf-8')).hexdigest()
+
+def sniff_image(fobj):
+    """
+Read only the header of an image file object and return a tuple of
+(format, (width, height)). No pixel data is decoded and the file position
+is restored afterwards. Raises IOError if the content is not an image.
+
+"""
+    position = fobj.tell()
+    try:
+        img = Image.open(fobj)
+        return img.format, img.size
+    finally:
+        fobj.seek(position)
+
+def open_upload(content, digest=None):
+    """
+Open uploaded content for decoding without sharing a file position with
+whoever else reads it (e.g. the storage backend saving it). digest, a
+hashlib object, is fed the bytes as they are read.
+
+"""
+    if hasattr(content, 'temporary_file_path'):
+        if digest is not None:
+            #decoded from the path, only the hash needs the bytes
+            for chunk in upload_chunks(content):
+                digest.update(chunk)
+        return Image.open(content.temporary_file_path())
+    return Image.open(StringIO(read_upload(content, digest)))
+
+def read_upload(content, digest=None):
+    """
+Return the bytes of uploaded content, leaving its file position alone.
+digest, a hashlib object, is fed the bytes as they are read.
+
+"""
+    chunks = list()
+    for chunk in upload_chunks(content):
+        if digest is not None:
+            digest.update(chunk)
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+def upload_chunks(content, chunk_size=64 * 1024):
+    """ Yields the bytes of uploaded content in chunks, from the start """
+    if hasattr(content, 'temporary_file_path'):
+        fobj = open(content.temporary_file_path(), 'rb')
+    else:
+        fobj = content
+        fobj.seek(0)
+    try:
+        while True:
+            chunk = fobj.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        if fobj is content:
+            content.seek(0)
+        else:
+            fobj.close()
+
+class BackgroundCall(object):
+    """
+Runs func(*args, **kwargs) on its own thread. get() waits for it and
+returns its result or re-raises its exception.
+
+"""
+    def __init__(self, func, *args, **kwargs):
+        self.result = None
+        self.exc_info = None
+        self.thread = threading.Thread(target=self.run, args=(func, args, kwargs))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self, func, args, kwargs):
+        try:
+            self.result = func(*args, **kwargs)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def get(self, timeout=None):
+        self.thread.join(timeout)
+        if self.thread.isAlive():
+            raise TimeoutError
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+class ThreadExecutor(object):
+    """
+Stands in for multiprocessing.pool.ThreadPool where multiprocessing is
+missing (Python 2.5): every apply_async() gets its own thread, and at most
+workers of them run func at once.
+
+"""
+    def __init__(self, workers):
+        self.slots = threading.Semaphore(workers)
+
+    def apply_async(self, func, args=(), kwargs={}):
+        return BackgroundCall(self._run, func, args, kwargs)
+
+    def _run(self, func, args, kwargs):
+        self.slots.acquire()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.slots.release()
+
+def get_thread_pool(workers):
+    """ A ThreadPool of workers threads, or a ThreadExecutor without multiprocessing """
+    try:
+        from multiprocessing.pool import ThreadPool
+    except ImportError:
+        return ThreadExecutor(workers)
+    return ThreadPool(workers)
+
+class StorageWriter(object):
+    """
+Saves files to a storage on background threads while the caller carries
+on, with at most max_pending saves queued or running at once. join()
+waits for every save; on success each callback receives its stored name,
+on failure the files that did get written are deleted again and the
+first error is re-raised.
+
+"""
+    def __init__(self, storage, max_pending):
+        self.storage = storage
+        self.slots = threading.Semaphore(max_pending)
+        self.pending = list()
+
+    def save(self, name, content, callback=None):
+        #blocks while max_pending saves are outstanding
+        self.slots.acquire()
+        self.pending.append((BackgroundCall(self._save, name, content), callback))
+
+    def _save(self, name, content):
+        try:
+            return self.storage.save(name, content)
+        finally:
+            self.slots.release()
+
+    def join(self):
+        pending, self.pending = self.pending, list()
+        stored = list()
+        error = None
+        for call, callback in pending:
+            try:
+                stored.append((call.get(), callback))
+            except:
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            for name, callback in stored:
+                try:
+                    self.storage.delete(name)
+                except Exception:
+                    pass
+            raise error[0], error[1], error[2]
+        for name, callback in stored:
+            if callback is not None:
+                callback(name)
+        return [name for name, callback in stored]
+
+def file_digest(fobj):
+    """
+Return the sha1 hex digest of a Django File, reading it in chunks.
+
+"""
+    digest = hashlib.sha1()
+    for chunk in fobj.chunks():
+        digest.update(chunk)
+    fobj.seek(0)
+    return digest.hexdigest()
+
+def map_in_threads(func, items, workers=None):
+    """
+Like map() but runs func on up to `workers` threads. The first exception
+raised by any call is re-raised once all calls have finished.
+
+"""
+    items = list(items)
+    if not workers or workers < 2 or len(items) < 2:
+        return map(func, items)
+    pool = get_thread_pool(min(workers, len(items)))
+    if isinstance(pool, ThreadExecutor):
+        calls = [pool.apply_async(func, (item,)) for item in items]
+        results = list()
+        error = None
+        for call in calls:
+            try:
+                results.append(call.get())
+            except:
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return results
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
 def image_entropy(im):
     """
 Calculate the entropy of an image. Used for "smart cropping".
@@ -33,6 +322,34 @@ Calculate the entropy of an image. Used for "smart cropping".
     hist = [h / hist_size for h in hist]
     return -sum([p * math.log(p, 2) for p in hist if p != 0])
 
+def entropy_box(im, width, height):
+    """
+Find the (left, top, right, bottom) box of width x height holding the most
+entropy, trimming the less detailed edge of each axis a slice at a time.
+
+"""
+    source_x, source_y = im.size
+    diff_x, diff_y = max(0, source_x - width), max(0, source_y - height)
+    left = top = 0
+    right, bottom = source_x, source_y
+    while diff_x:
+        slice = min(diff_x, max(diff_x // 5, 10))
+        start = im.crop((left, 0, left + slice, source_y))
+        end = im.crop((right - slice, 0, right, source_y))
+        add, remove = _compare_entropy(start, end, slice, diff_x)
+        left += add
+        right -= remove
+        diff_x = diff_x - add - remove
+    while diff_y:
+        slice = min(diff_y, max(diff_y // 5, 10))
+        start = im.crop((0, top, source_x, top + slice))
+        end = im.crop((0, bottom - slice, source_x, bottom))
+        add, remove = _compare_entropy(start, end, slice, diff_y)
+        top += add
+        bottom -= remove
+        diff_y = diff_y - add - remove
+    return left, top, right, bottom
+
 def _compare_entropy(start_slice, end_slice, slice, difference):
     """
 Calculate the entropy of two slices (from the start and end of an axis),
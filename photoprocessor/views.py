@@ -0,0 +1,73 @@
+import hashlib
+import mimetypes
+
+from django.db import models
+from django.db.models.fields import FieldDoesNotExist
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseNotModified, \
+    HttpResponseForbidden
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import constant_time_compare
+from django.utils.http import parse_etags, quote_etag
+
+from fields import ImageWithProcessorsField
+from utils import thumbnail_signature
+
+
+def thumbnail(request, app_label, model_name, pk, field_name, key):
+    """
+    Serves the thumbnail `key` of an object's image field, generating it on
+    the first request if it is missing or stale. Only fields with serve=True
+    are answered, and only for the signed urls lazy_url hands out. Responses
+    carry a strong ETag so repeat requests are answered with 304 Not Modified.
+    """
+    from settings import SERVE_MODE, SERVE_MAX_AGE, SERVE_REDIRECT_MAX_AGE
+    model = models.get_model(app_label, model_name)
+    if model is None:
+        raise Http404
+    try:
+        field = model._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        raise Http404
+    if not isinstance(field, ImageWithProcessorsField) or not field.serve or key not in field.thumbnails:
+        raise Http404
+    signature = thumbnail_signature(app_label, model_name, pk, field_name, key)
+    if not constant_time_compare(request.GET.get('sig', ''), signature):
+        return HttpResponseForbidden()
+    obj = get_object_or_404(model._default_manager, pk=pk)
+    field_file = getattr(obj, field.name)
+    if not field_file:
+        raise Http404
+    
+    if not field_file.is_current(key):
+        try:
+            deferred = field_file.generate_admitted([key])
+        except IOError:
+            raise Http404
+        if deferred is not None:
+            #over the admission budget, the work was handed to thumbnail_deferred
+            from admission import get_budget
+            response = HttpResponse('Thumbnail not available yet', status=503, content_type='text/plain')
+            response['Retry-After'] = str(get_budget().retry_after)
+            patch_cache_control(response, no_cache=True)
+            return response
+    thumb = field_file[key]
+    
+    etag = hashlib.sha1('%s:%s' % (thumb.name, field.get_pipeline(key).fingerprint)).hexdigest()
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    elif SERVE_MODE == 'file':
+        content_type = mimetypes.guess_type(thumb.name)[0] or 'application/octet-stream'
+        thumb.open()
+        try:
+            response = HttpResponse(thumb.read(), content_type=content_type)
+        finally:
+            thumb.close()
+    else:
+        response = HttpResponseRedirect(thumb.url)
+    response['ETag'] = quote_etag(etag)
+    if SERVE_MODE == 'file':
+        patch_cache_control(response, public=True, max_age=SERVE_MAX_AGE)
+    else:
+        patch_cache_control(response, private=True, max_age=SERVE_REDIRECT_MAX_AGE)
+    return response
@@ -14,7 +14,7 @@ setup(
     author_email='jasonk@cukerinteractive.com',
     license='BSD',
     url='http://github.com/cuker/django-photoprocessor/',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     test_suite='tests.setuptest.SetupTestSuite',
     tests_require=(
         'pep8==1.3.1',